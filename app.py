@@ -2,13 +2,48 @@
 股票推荐系统 - Flask主程序
 """
 from flask import Flask, jsonify, request, send_from_directory
+from flask.json.provider import DefaultJSONProvider
 from datetime import datetime
+import contextlib
+import logging
 import os
+import time
+
+import orjson
 
 import config
+from services import cache
+from services import json_codec
+from services import stock as stock_service
+from services.cache_db import get_db
 from services.recommendation import get_service
 
+logging.basicConfig(level=config.LOG_LEVEL, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+
+# ==================== JSON ====================
+
+class OrjsonProvider(DefaultJSONProvider):
+    """使用 orjson 序列化响应、解析请求体，替代标准库 json（编码选项与 Redis 缓存共用）"""
+
+    def dumps(self, obj, **kwargs) -> str:
+        option = 0
+        if kwargs.get('sort_keys', self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.get('indent'):
+            option |= orjson.OPT_INDENT_2
+        return json_codec.dumps(obj, option).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        # request.get_json / request.json 也走 orjson 解析
+        return orjson.loads(s)
+
+
 app = Flask(__name__, static_folder='static')
+app.json = OrjsonProvider(app)
+# 响应不排序键、不缩进（包括 DEBUG 模式）
+app.json.sort_keys = False
+app.json.compact = True
 
 
 # ==================== 静态页面 ====================
@@ -26,9 +61,19 @@ def static_files(filename):
 
 @app.route('/api/recommendation/<int:year>/<int:week>/ranking', methods=['GET'])
 def get_ranking(year, week):
-    """获取排行榜数据"""
+    """获取排行榜数据
+    
+    ?limit=N 只返回涨跌幅前N名（不传返回全部）
+    """
+    limit = request.args.get('limit', type=int)
+    if limit is not None and limit <= 0:
+        limit = None
+    
     service = get_service()
-    data = service.get_ranking(year, week)
+    data = cache.cached(
+        cache.ranking_key(year, week, limit), cache.ranking_ttl(year, week),
+        lambda: service.get_ranking(year, week, limit=limit)
+    )
     return jsonify({'data': data})
 
 
@@ -36,7 +81,7 @@ def get_ranking(year, week):
 def get_recommenders():
     """获取推荐人统计"""
     service = get_service()
-    data = service.get_recommender_stats()
+    data = cache.cached(cache.RECOMMENDERS_KEY, cache.CURRENT_WEEK_TTL, service.get_recommender_stats)
     return jsonify({'data': data})
 
 
@@ -45,7 +90,6 @@ def get_recommenders():
 @app.route('/api/admin/weeks', methods=['GET'])
 def get_weeks():
     """获取所有周列表"""
-    from services.mongodb_db import get_db
     db = get_db()
     weeks = db.get_all_weeks()
     return jsonify({'data': weeks})
@@ -54,7 +98,6 @@ def get_weeks():
 @app.route('/api/admin/week/<int:year>/<int:week>', methods=['GET'])
 def get_week_detail(year, week):
     """获取周详情"""
-    from services.mongodb_db import get_db
     db = get_db()
     data = db.get_week_data(year, week)
     return jsonify({'data': data})
@@ -73,6 +116,7 @@ def submit_raw_text():
     
     service = get_service()
     result = service.submit_raw_text(year, week, raw_text)
+    cache.invalidate_week(year, week)
     return jsonify({'data': result})
 
 
@@ -88,6 +132,7 @@ def parse_recommendations():
     
     service = get_service()
     result = service.parse_with_gemini(year, week)
+    cache.invalidate_week(year, week)
     
     if 'error' in result:
         return jsonify({'error': result['error']}), 500
@@ -107,6 +152,7 @@ def resolve_codes():
     
     service = get_service()
     result = service.resolve_stock_codes(year, week)
+    cache.invalidate_week(year, week)
     return jsonify({'data': result})
 
 
@@ -122,6 +168,7 @@ def fetch_kline():
     
     service = get_service()
     result = service.fetch_kline_data(year, week)
+    cache.invalidate_week(year, week)
     return jsonify({'data': result})
 
 
@@ -130,6 +177,7 @@ def recalculate_stats():
     """重算推荐人统计"""
     service = get_service()
     result = service.calculate_recommender_stats()
+    cache.invalidate_stats()
     return jsonify({'data': {'count': result.get('count', 0)}})
 
 
@@ -143,9 +191,9 @@ def delete_week():
     if not year or not week:
         return jsonify({'error': '缺少年份或周数'}), 400
     
-    from services.mongodb_db import get_db
     db = get_db()
     success = db.delete_week(year, week)
+    cache.invalidate_week(year, week)
     return jsonify({'data': {'deleted': success}})
 
 
@@ -160,9 +208,9 @@ def delete_stock():
     if not year or not week or not stock_name:
         return jsonify({'error': '缺少必要参数'}), 400
     
-    from services.mongodb_db import get_db
     db = get_db()
     success = db.delete_stock(year, week, stock_name)
+    cache.invalidate_week(year, week)
     return jsonify({'data': {'deleted': success}})
 
 
@@ -178,18 +226,28 @@ def update_stock():
     if not year or not week or not old_stock_name:
         return jsonify({'error': '缺少必要参数'}), 400
     
-    from services.mongodb_db import get_db
     db = get_db()
     success = db.update_stock_full(year, week, old_stock_name, new_data)
+    cache.invalidate_week(year, week)
     return jsonify({'data': {'updated': success}})
 
 
+CURRENT_WEEK_MAX_AGE = 60
+_current_week = {'expires': 0.0, 'value': None}
+
+
 @app.route('/api/admin/current-week', methods=['GET'])
 def get_current_week():
-    """获取当前周信息"""
-    now = datetime.now()
-    year, week, _ = now.isocalendar()
-    return jsonify({'data': {'year': year, 'week': week}})
+    """获取当前周信息（每分钟计算一次）"""
+    now = time.monotonic()
+    if now >= _current_week['expires']:
+        year, week, _ = datetime.now().isocalendar()
+        _current_week['value'] = {'year': year, 'week': week}
+        _current_week['expires'] = now + CURRENT_WEEK_MAX_AGE
+    
+    response = jsonify({'data': _current_week['value']})
+    response.headers['Cache-Control'] = f'public, max-age={CURRENT_WEEK_MAX_AGE}'
+    return response
 
 
 @app.route('/api/admin/search-stock', methods=['GET'])
@@ -199,7 +257,6 @@ def search_stock_api():
     if not stock_name:
         return jsonify({'error': '缺少股票名称'}), 400
     
-    from services import stock as stock_service
     result = stock_service.search_stock(stock_name)
     if result:
         return jsonify({'data': result})
@@ -211,9 +268,16 @@ def search_stock_api():
 
 @app.route('/api/stock-tracking', methods=['GET'])
 def get_all_stock_tracking():
-    """获取所有股票跟踪数据"""
+    """获取所有股票跟踪数据
+    
+    ?view=summary 仅返回列表字段和推荐数量；?skip=&limit= 分页
+    """
+    summary = request.args.get('view') == 'summary'
+    skip = max(request.args.get('skip', 0, type=int), 0)
+    limit = max(request.args.get('limit', 0, type=int), 0)
+    
     service = get_service()
-    result = service.get_all_stock_tracking()
+    result = service.get_all_stock_tracking(summary=summary, skip=skip, limit=limit)
     return jsonify({'data': result})
 
 
@@ -225,6 +289,50 @@ def get_stock_tracking(market, code):
     return jsonify({'data': result})
 
 
+# 批量接口单次最多查询的股票数
+BATCH_MAX_STOCKS = 200
+BATCH_BODY_ERROR = '请求体格式错误，应为 {"stocks": [{"market": "SH", "code": "600519"}, ...]}'
+
+
+def _parse_stock_keys(data):
+    """解析批量请求体 {"stocks": [{"market": "SH", "code": "600519"}, ...]}，去重保序
+    
+    请求体不是对象或 stocks 不是数组时返回 None
+    """
+    if data is None:
+        data = {}
+    if not isinstance(data, dict):
+        return None
+    stocks = data.get('stocks') or []
+    if not isinstance(stocks, list):
+        return None
+    
+    keys = []
+    seen = set()
+    for item in stocks:
+        if not isinstance(item, dict):
+            continue
+        market = str(item.get('market') or '').upper()
+        code = str(item.get('code') or '')
+        if market and code and (market, code) not in seen:
+            seen.add((market, code))
+            keys.append((market, code))
+    return keys
+
+
+@app.route('/api/stock-tracking/batch', methods=['POST'])
+def get_stock_tracking_batch():
+    """批量获取股票跟踪数据，返回 {"MARKET.code": 跟踪数据}"""
+    keys = _parse_stock_keys(request.get_json(silent=True))
+    if keys is None:
+        return jsonify({'error': BATCH_BODY_ERROR}), 400
+    if len(keys) > BATCH_MAX_STOCKS:
+        return jsonify({'error': f'单次最多查询{BATCH_MAX_STOCKS}只股票'}), 400
+    
+    db = get_db()
+    return jsonify({'data': db.get_stock_tracking_batch(keys)})
+
+
 @app.route('/api/admin/sync-tracking', methods=['POST'])
 def sync_stock_tracking():
     """同步股票跟踪数据"""
@@ -236,7 +344,6 @@ def sync_stock_tracking():
 @app.route('/api/admin/clear-tracking', methods=['POST'])
 def clear_stock_tracking():
     """清空股票跟踪数据"""
-    from services.mongodb_db import get_db
     db = get_db()
     deleted = db.clear_stock_tracking()
     return jsonify({'data': {'deleted': deleted}})
@@ -245,7 +352,6 @@ def clear_stock_tracking():
 @app.route('/api/admin/reset-week-sync/<int:year>/<int:week>', methods=['POST'])
 def reset_week_sync(year, week):
     """重置周同步状态并删除该周跟踪数据"""
-    from services.mongodb_db import get_db
     db = get_db()
     deleted = db.reset_week_tracking_sync(year, week)
     return jsonify({'data': {'success': True, 'deleted': deleted}})
@@ -256,7 +362,6 @@ def reset_week_sync(year, week):
 @app.route('/api/stock-materials', methods=['GET'])
 def get_stock_materials_index():
     """获取所有股票的相关资料索引"""
-    from services.mongodb_db import get_db
     db = get_db()
     index = db.get_all_materials_index()
     return jsonify({'data': index})
@@ -265,59 +370,95 @@ def get_stock_materials_index():
 @app.route('/api/stock-materials/<market>/<code>', methods=['GET'])
 def get_stock_materials(market, code):
     """获取单只股票的相关资料详情"""
-    from services.mongodb_db import get_db
     db = get_db()
     materials = db.get_materials_by_stock(market.upper(), code)
     return jsonify({'data': materials})
 
 
+@app.route('/api/stock-materials/batch', methods=['POST'])
+def get_stock_materials_batch():
+    """批量获取多只股票的相关资料详情，返回 {"MARKET.code": [资料, ...]}"""
+    data = request.get_json(silent=True) or {}
+    keys = _parse_stock_keys(data)
+    if keys is None:
+        return jsonify({'error': BATCH_BODY_ERROR}), 400
+    if len(keys) > BATCH_MAX_STOCKS:
+        return jsonify({'error': f'单次最多查询{BATCH_MAX_STOCKS}只股票'}), 400
+    limit = data.get('limit')
+    # bool 是 int 的子类，true/false 不作为条数
+    limit = min(max(limit, 1), 50) if isinstance(limit, int) and not isinstance(limit, bool) else 10
+    
+    db = get_db()
+    return jsonify({'data': db.get_materials_by_stocks(keys, limit)})
+
+
 # ==================== 研报管理 API ====================
 
 REPORTS_DIR = os.path.join(os.path.dirname(__file__), 'reports')
+REPORT_MAX_AGE = 3600
 
-@app.route('/api/reports', methods=['GET'])
-def list_reports():
-    """获取所有研报列表"""
-    if not os.path.exists(REPORTS_DIR):
-        return jsonify({'data': []})
-    
-    reports = []
+# 研报索引缓存，目录 mtime 变化（增删文件）时重建
+_reports_cache = {'mtime': None, 'data': None}
+
+
+def _scan_reports() -> list:
+    """扫描研报目录，构建研报列表"""
     # 优先查找 .url 文件，其次是 .html 文件
     # 实际上由于互斥逻辑，每个 code 应该只有其中一种
-    files = os.listdir(REPORTS_DIR)
-    
-    # 收集所有的 stock_code
-    codes = set()
-    for f in files:
-        if f.endswith('.html') or f.endswith('.url'):
-            codes.add(f.rsplit('.', 1)[0])
-            
-    for code in codes:
-        url_file = f"{code}.url"
-        html_file = f"{code}.html"
-        
-        if url_file in files:
-            # 读取 URL 内容
-            try:
-                with open(os.path.join(REPORTS_DIR, url_file), 'r', encoding='utf-8') as f:
-                    url = f.read().strip()
-                reports.append({
-                    'stock_code': code,
-                    'type': 'link',
-                    'url': url,
-                    'filename': url_file
-                })
-            except Exception as e:
-                print(f"Error reading {url_file}: {e}")
-        elif html_file in files:
+    url_files = {}
+    html_files = {}
+    with os.scandir(REPORTS_DIR) as entries:
+        for entry in entries:
+            code, _, ext = entry.name.rpartition('.')
+            if ext == 'url':
+                url_files[code] = entry.path
+            elif ext == 'html':
+                html_files[code] = entry.name
+    
+    reports = []
+    for code, path in url_files.items():
+        # 读取 URL 内容
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                url = f.read().strip()
             reports.append({
                 'stock_code': code,
-                'type': 'file',
-                'url': f"/reports/{html_file}",
-                'filename': html_file
+                'type': 'link',
+                'url': url,
+                'filename': f"{code}.url"
             })
-            
-    return jsonify({'data': reports})
+        except Exception as e:
+            print(f"Error reading {code}.url: {e}")
+    
+    for code, html_file in html_files.items():
+        if code in url_files:
+            continue
+        reports.append({
+            'stock_code': code,
+            'type': 'file',
+            'url': f"/reports/{html_file}",
+            'filename': html_file
+        })
+    return reports
+
+
+def _invalidate_reports_cache():
+    _reports_cache['mtime'] = None
+
+
+@app.route('/api/reports', methods=['GET'])
+def list_reports():
+    """获取所有研报列表"""
+    try:
+        mtime = os.stat(REPORTS_DIR).st_mtime
+    except FileNotFoundError:
+        return jsonify({'data': []})
+    
+    if _reports_cache['mtime'] != mtime:
+        _reports_cache['data'] = _scan_reports()
+        _reports_cache['mtime'] = mtime
+    
+    return jsonify({'data': _reports_cache['data']})
 
 
 @app.route('/api/reports/upload', methods=['POST'])
@@ -339,10 +480,9 @@ def upload_report():
     os.makedirs(REPORTS_DIR, exist_ok=True)
     
     # 清理旧文件 (互斥)
-    old_html = os.path.join(REPORTS_DIR, f'{stock_code}.html')
-    old_url = os.path.join(REPORTS_DIR, f'{stock_code}.url')
-    if os.path.exists(old_html): os.remove(old_html)
-    if os.path.exists(old_url): os.remove(old_url)
+    for ext in ('html', 'url'):
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(os.path.join(REPORTS_DIR, f'{stock_code}.{ext}'))
     
     if report_type == 'link':
         link = request.form.get('link', '').strip()
@@ -352,6 +492,7 @@ def upload_report():
         # 保存 .url 文件
         with open(os.path.join(REPORTS_DIR, f'{stock_code}.url'), 'w', encoding='utf-8') as f:
             f.write(link)
+        _invalidate_reports_cache()
         
         return jsonify({'data': {'saved': True, 'stock_code': stock_code, 'type': 'link'}})
         
@@ -365,6 +506,7 @@ def upload_report():
         
         # 保存 .html 文件
         file.save(os.path.join(REPORTS_DIR, f'{stock_code}.html'))
+        _invalidate_reports_cache()
         
         return jsonify({'data': {'saved': True, 'stock_code': stock_code, 'type': 'file'}})
 
@@ -374,25 +516,23 @@ def delete_report(stock_code):
     """删除研报 (同时尝试删除 .html 和 .url)"""
     deleted = False
     
-    html_path = os.path.join(REPORTS_DIR, f'{stock_code}.html')
-    if os.path.exists(html_path):
-        os.remove(html_path)
-        deleted = True
-        
-    url_path = os.path.join(REPORTS_DIR, f'{stock_code}.url')
-    if os.path.exists(url_path):
-        os.remove(url_path)
-        deleted = True
+    for ext in ('html', 'url'):
+        try:
+            os.unlink(os.path.join(REPORTS_DIR, f'{stock_code}.{ext}'))
+            deleted = True
+        except FileNotFoundError:
+            pass
         
     if deleted:
+        _invalidate_reports_cache()
         return jsonify({'data': {'deleted': True}})
     return jsonify({'error': '文件不存在'}), 404
 
 
 @app.route('/reports/<path:filename>')
 def serve_report(filename):
-    """静态访问研报文件"""
-    return send_from_directory(REPORTS_DIR, filename)
+    """静态访问研报文件（浏览器缓存1小时，过期后按 ETag/Last-Modified 协商）"""
+    return send_from_directory(REPORTS_DIR, filename, max_age=REPORT_MAX_AGE, conditional=True)
 
 
 # ==================== 错误处理 ====================
@@ -10,10 +10,16 @@ DEBUG = True
 HOST = '0.0.0.0'
 PORT = 5001
 
+# 日志级别（DEBUG 时输出逐只股票的处理明细）
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+
 # MongoDB配置
 MONGODB_URI = os.getenv('MONGODB_URI', '')
 MONGODB_DB = os.getenv('MONGODB_DB', '')
 
+# Redis配置（可选，用于缓存排行榜和推荐人统计，留空则不缓存）
+REDIS_URL = os.getenv('REDIS_URL', '')
+
 # Excel配置 (已废弃，保留 BASE_DIR/DATA_DIR 供其他用途)
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_DIR = os.path.join(BASE_DIR, 'data')
@@ -0,0 +1,16 @@
+# Gunicorn 配置（生产部署）
+# 启动: gunicorn -c gunicorn.conf.py app:app
+import os
+
+import config
+
+bind = f"{config.HOST}:{config.PORT}"
+
+# gevent 协程 worker：worker 启动时自动 monkey patch，
+# requests / pymongo 的阻塞 socket 调用会被协作调度
+worker_class = 'gevent'
+worker_connections = 1000
+
+# 单进程即可承载大量并发 I/O，进程内单例/缓存保持一致
+# 多进程时各进程的读缓存（services/cache_db.py）独立，跨进程最多延迟 CACHE_TTL 秒可见
+workers = int(os.getenv('GUNICORN_WORKERS', '1'))
@@ -5,16 +5,56 @@ Ashare 股票行情数据接口
 基于开源项目 https://github.com/mpquant/Ashare
 用于获取A股（含北交所）股票行情数据
 """
-import json
+import os
+import time
 import datetime
 import logging
+import threading
 from typing import Optional, List, Dict, Any
 
+import orjson
 import requests
 import pandas as pd
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import config
+
+try:
+    import diskcache
+except ImportError:  # 未安装 diskcache 时仅使用进程内缓存
+    diskcache = None
 
 logger = logging.getLogger(__name__)
 
+# 周K线结果缓存：历史周数据不变，当前周短缓存
+KLINE_CACHE_DIR = os.path.join(config.DATA_DIR, 'kline_cache')
+KLINE_PAST_WEEK_TTL = 7 * 24 * 3600
+KLINE_CURRENT_WEEK_TTL = 3600
+KLINE_CACHE_MAXSIZE = 4096
+
+_kline_cache = {}  # (market, code, year, week) -> (过期时间, 结果)
+_kline_cache_lock = threading.Lock()
+_kline_disk_cache = None
+
+# 共享连接池：批量同步K线时复用 TCP 连接（requests.Session 可跨线程使用）
+# 频率限制(456)和服务端错误自动退避重试，重试耗尽后返回原响应由调用方处理
+_session = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=Retry(total=2, backoff_factor=0.3,
+                      status_forcelist=[456, 500, 502, 503, 504], raise_on_status=False)
+)
+_session.mount('http://', _adapter)
+_session.mount('https://', _adapter)
+
+# 各行情源并发上限，多线程批量获取时避免触发频率限制（新浪 456）
+_tx_limit = threading.BoundedSemaphore(8)
+_sina_limit = threading.BoundedSemaphore(4)
+
+# 行情列类型，一次 astype 完成转换
+_PRICE_DTYPES = {'open': float, 'close': float, 'high': float, 'low': float, 'volume': float}
+
 
 def get_price_day_tx(code: str, end_date: str = '', count: int = 10, frequency: str = '1d') -> pd.DataFrame:
     code = code.lower()
@@ -33,7 +73,9 @@ def get_price_day_tx(code: str, end_date: str = '', count: int = 10, frequency:
     url = f'http://web.ifzq.gtimg.cn/appstock/app/fqkline/get?param={code},{unit},,{end_date},{count},qfq'
 
     try:
-        st = json.loads(requests.get(url, timeout=10).content)
+        with _tx_limit:
+            content = _session.get(url, timeout=10).content
+        st = orjson.loads(content)
 
         ms = 'qfq' + unit
         stk = st['data'][code]
@@ -48,12 +90,9 @@ def get_price_day_tx(code: str, end_date: str = '', count: int = 10, frequency:
         
         # 不在初始化时指定 dtype，避免日期列转换失败
         df = pd.DataFrame(buf, columns=['time', 'open', 'close', 'high', 'low', 'volume'])
-        df['open'] = df['open'].astype(float)
-        df['close'] = df['close'].astype(float)
-        df['high'] = df['high'].astype(float)
-        df['low'] = df['low'].astype(float)
-        df['volume'] = df['volume'].astype(float)
-        df['time'] = pd.to_datetime(df['time'])
+        df = df.astype(_PRICE_DTYPES)
+        # 腾讯日/周/月线日期固定为 YYYY-MM-DD，显式格式跳过格式推断
+        df['time'] = pd.to_datetime(df['time'], format='%Y-%m-%d')
         df.set_index(['time'], inplace=True)
         df.index.name = ''
         return df
@@ -77,19 +116,15 @@ def get_price_sina(code: str, end_date: str = '', count: int = 10, frequency: st
     url = f'http://money.finance.sina.com.cn/quotes_service/api/json_v2.php/CN_MarketData.getKLineData?symbol={code}&scale={ts}&ma=5&datalen={count}'
     
     try:
-        res = requests.get(url, timeout=10)
+        with _sina_limit:
+            res = _session.get(url, timeout=10)
         if res.status_code != 200:
             if res.status_code == 456:
                 raise Exception(f"新浪数据获取失败: {code}, 频率限制")
             raise Exception(f"新浪数据获取失败: {code}, 状态码: {res.status_code}")
-        raw = res.content.decode('utf-8')
-        dstr = json.loads(raw)
+        dstr = orjson.loads(res.content)
         df = pd.DataFrame(dstr, columns=['day', 'open', 'high', 'low', 'close', 'volume'])
-        df['open'] = df['open'].astype(float)
-        df['high'] = df['high'].astype(float)
-        df['low'] = df['low'].astype(float)
-        df['close'] = df['close'].astype(float)
-        df['volume'] = df['volume'].astype(float)
+        df = df.astype(_PRICE_DTYPES)
         df.day = pd.to_datetime(df.day)
         df.set_index(['day'], inplace=True)
         df.index.name = ''
@@ -115,14 +150,67 @@ def get_price(code: str, end_date: str = '', count: int = 10, frequency: str = '
         try:
             return get_price_day_tx(xcode, end_date=end_date, count=count, frequency=frequency)
         except Exception as e:
-            print(f"{code}: 腾讯接口失败({e})，切换到新浪接口")
+            logger.warning("%s: 腾讯接口失败(%s)，切换到新浪接口", code, e)
             return get_price_sina(xcode, end_date=end_date, count=count, frequency=frequency)
     
     raise ValueError(f"不支持的周期: {frequency}")
 
 
+def _get_disk_cache():
+    global _kline_disk_cache
+    if _kline_disk_cache is None and diskcache is not None:
+        try:
+            _kline_disk_cache = diskcache.Cache(KLINE_CACHE_DIR)
+        except Exception as e:
+            logger.warning("K线磁盘缓存不可用: %s", e)
+    return _kline_disk_cache
+
+
+def _kline_cache_get(key: tuple) -> Optional[Dict[str, Any]]:
+    with _kline_cache_lock:
+        entry = _kline_cache.get(key)
+        if entry is not None:
+            if entry[0] > time.time():
+                return dict(entry[1])
+            del _kline_cache[key]
+    
+    disk = _get_disk_cache()
+    if disk is not None:
+        try:
+            value, expire_at = disk.get(key, expire_time=True)
+        except Exception:
+            value = None
+        if value is not None:
+            # 进程内只保留短缓存，且不晚于磁盘条目本身的过期时间（无过期时间时按短缓存）
+            memory_expire_at = time.time() + KLINE_CURRENT_WEEK_TTL
+            if expire_at is not None:
+                memory_expire_at = min(expire_at, memory_expire_at)
+            _kline_memory_put(key, value, memory_expire_at)
+            return dict(value)
+    return None
+
+
+def _kline_memory_put(key: tuple, value: Dict[str, Any], expire_at: float):
+    """写入进程内缓存，满了淘汰最早写入的条目"""
+    with _kline_cache_lock:
+        if key not in _kline_cache and len(_kline_cache) >= KLINE_CACHE_MAXSIZE:
+            _kline_cache.pop(next(iter(_kline_cache)))
+        _kline_cache[key] = (expire_at, dict(value))
+
+
+def _kline_cache_set(key: tuple, value: Dict[str, Any], ttl: int):
+    _kline_memory_put(key, value, time.time() + ttl)
+    
+    disk = _get_disk_cache()
+    if disk is not None:
+        try:
+            disk.set(key, dict(value), expire=ttl)
+        except Exception as e:
+            logger.warning("K线磁盘缓存写入失败: %s, %s", key, e)
+
+
 def get_kline(market: str, code: str, year: int, week: int) -> Optional[Dict[str, Any]]:
-    """获取周K线数据
+    """获取周K线数据（带缓存）
     
     Args:
         market: 市场代码 (sh/sz/bj)
@@ -135,34 +223,49 @@ def get_kline(market: str, code: str, year: int, week: int) -> Optional[Dict[str
     """
     from services.stock import get_week_dates
     
+    key = (market.lower(), code, year, week)
+    cached = _kline_cache_get(key)
+    if cached is not None:
+        return cached
+    
+    result = _fetch_kline(market, code, year, week)
+    if result:
+        # 周五已过的历史周数据不再变化
+        _, end_date = get_week_dates(year, week)
+        is_past = end_date < datetime.datetime.now().strftime('%Y%m%d')
+        _kline_cache_set(key, result, KLINE_PAST_WEEK_TTL if is_past else KLINE_CURRENT_WEEK_TTL)
+    return result
+
+
+def _fetch_kline(market: str, code: str, year: int, week: int) -> Optional[Dict[str, Any]]:
+    """从行情接口获取周K线数据"""
+    from services.stock import get_week_range
+    
     try:
-        start_date, end_date = get_week_dates(year, week)
+        start_date_fmt, end_date_fmt = get_week_range(year, week)
         ashare_code = market + code
         
-        # 格式化日期
-        end_date_fmt = f"{end_date[:4]}-{end_date[4:6]}-{end_date[6:]}"
-        start_date_fmt = f"{start_date[:4]}-{start_date[4:6]}-{start_date[6:]}"
-        
         # 如果结束日期是未来，使用当天日期
         today = datetime.datetime.now().strftime('%Y-%m-%d')
         actual_end_date = min(end_date_fmt, today)
         
-        print(f"Ashare获取K线: {ashare_code}, 周期={start_date_fmt}~{end_date_fmt}, 实际截止={actual_end_date}")
+        logger.debug("Ashare获取K线: %s, 周期=%s~%s, 实际截止=%s", ashare_code, start_date_fmt, end_date_fmt, actual_end_date)
         
         # 获取更多数据以确保覆盖当周
         df = get_price(ashare_code, end_date=actual_end_date, count=10, frequency='1d')
 
         if df.empty:
-            print(f"Ashare K线为空: {ashare_code}")
+            logger.debug("Ashare K线为空: %s", ashare_code)
             return None
         
-        # 过滤当周数据（使用实际结束日期）
-        start_dt = pd.to_datetime(start_date_fmt)
-        end_dt = pd.to_datetime(actual_end_date)
-        week_df = df[(df.index >= start_dt) & (df.index <= end_dt)]
+        # 过滤当周数据（使用实际结束日期），按升序日期索引做标签切片
+        if not df.index.is_monotonic_increasing:
+            df = df.sort_index()
+        week_df = df.loc[start_date_fmt:actual_end_date]
         
         if week_df.empty:
-            print(f"Ashare 周内无数据: {ashare_code}, 原始数据范围={df.index.min()}~{df.index.max()}, 过滤范围={start_dt}~{end_dt}")
+            logger.debug("Ashare 周内无数据: %s, 原始数据范围=%s~%s, 过滤范围=%s~%s",
+                         ashare_code, df.index.min(), df.index.max(), start_date_fmt, actual_end_date)
             return None
         
         open_price = float(week_df.iloc[0]['open'])
@@ -176,5 +279,5 @@ def get_kline(market: str, code: str, year: int, week: int) -> Optional[Dict[str
         }
         
     except Exception as e:
-        logger.error(f"Ashare获取K线失败: {market}{code}, {e}")
+        logger.error("Ashare获取K线失败: %s%s, %s", market, code, e)
         return None
@@ -0,0 +1,114 @@
+"""
+Redis 缓存
+
+排行榜、推荐人统计等读多写少接口的结果缓存
+未配置 REDIS_URL 或 Redis 异常时直接回源数据库
+"""
+import logging
+from datetime import datetime
+from typing import Any, Callable, Optional
+
+import orjson
+import config
+from services import json_codec
+
+try:
+    import redis
+except ImportError:  # 未安装 redis 时不启用缓存
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+RECOMMENDERS_KEY = 'recommenders:v1'
+
+CURRENT_WEEK_TTL = 24 * 3600      # 当前周：24小时
+PAST_WEEK_TTL = 30 * 24 * 3600    # 历史周：30天（数据基本不再变化）
+
+_client = None
+
+
+def _get_client():
+    global _client
+    if _client is None and redis is not None and config.REDIS_URL:
+        _client = redis.Redis.from_url(config.REDIS_URL, socket_timeout=1, socket_connect_timeout=1)
+    return _client
+
+
+def ranking_key(year: int, week: int, limit: Optional[int] = None) -> str:
+    if limit:
+        return f"ranking:{year}:{week}:top{limit}"
+    return f"ranking:{year}:{week}"
+
+
+def ranking_ttl(year: int, week: int) -> int:
+    """历史周长缓存，当前周（及未来周）短缓存"""
+    cur_year, cur_week, _ = datetime.now().isocalendar()
+    if (year, week) < (cur_year, cur_week):
+        return PAST_WEEK_TTL
+    return CURRENT_WEEK_TTL
+
+
+def get_json(key: str) -> Optional[Any]:
+    client = _get_client()
+    if client is None:
+        return None
+    try:
+        raw = client.get(key)
+    except redis.RedisError as e:
+        logger.warning("Redis读取失败: %s, %s", key, e)
+        return None
+    return orjson.loads(raw) if raw is not None else None
+
+
+def set_json(key: str, value: Any, ttl: int):
+    client = _get_client()
+    if client is None:
+        return
+    try:
+        # 与响应使用相同的编码选项，缓存命中时输出与直接查询一致
+        client.set(key, json_codec.dumps(value), ex=ttl)
+    except (redis.RedisError, TypeError) as e:  # orjson.JSONEncodeError 是 TypeError 子类
+        logger.warning("Redis写入失败: %s, %s", key, e)
+
+
+def cached(key: str, ttl: int, loader: Callable[[], Any]) -> Any:
+    """命中缓存直接返回，否则调用 loader 并写入缓存"""
+    data = get_json(key)
+    if data is None:
+        data = loader()
+        set_json(key, data, ttl)
+    return data
+
+
+def delete(*keys: str):
+    client = _get_client()
+    if client is None or not keys:
+        return
+    try:
+        client.delete(*keys)
+    except redis.RedisError as e:
+        logger.warning("Redis删除失败: %s, %s", keys, e)
+
+
+def delete_pattern(pattern: str):
+    client = _get_client()
+    if client is None:
+        return
+    try:
+        keys = list(client.scan_iter(match=pattern, count=500))
+        if keys:
+            client.delete(*keys)
+    except redis.RedisError as e:
+        logger.warning("Redis批量删除失败: %s, %s", pattern, e)
+
+
+def invalidate_week(year: int, week: int):
+    """周数据变更后清除该周排行榜缓存（含各 limit 的前N名缓存）"""
+    delete(ranking_key(year, week))
+    delete_pattern(f"{ranking_key(year, week)}:*")
+
+
+def invalidate_stats():
+    """推荐人统计变更后清除统计及所有排行榜缓存（排行榜包含推荐人评级）"""
+    delete(RECOMMENDERS_KEY)
+    delete_pattern('ranking:*')
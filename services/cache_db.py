@@ -0,0 +1,191 @@
+"""
+周数据/推荐人统计读缓存
+
+在 MongoDB 前加一层进程内缓存：周数据按 year+week 做 LRU，推荐人统计整体缓存
+写操作直接写库（write-through），写完使对应缓存失效；其余方法原样委托给 MongoDB
+缓存只在本进程内失效，多 worker 部署时其他进程最多在 CACHE_TTL 秒内读到旧数据
+（通过 get_db() 获取实例；请勿直接使用 MongoDB()，否则写入不会使缓存失效）
+"""
+import copy
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List
+
+from services.mongodb_db import MongoDB
+
+# 最多缓存的周数
+WEEK_CACHE_MAXSIZE = 32
+# 缓存有效期（秒）：兜底其他 worker 进程写入造成的不一致
+CACHE_TTL = 30
+
+
+class CachedDB:
+    """带读缓存的数据库包装"""
+
+    def __init__(self, backend: MongoDB, maxsize: int = WEEK_CACHE_MAXSIZE, ttl: float = CACHE_TTL):
+        self._backend = backend
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._weeks: OrderedDict = OrderedDict()  # (year, week) -> (过期时间, 周数据)
+        self._stats = None  # (过期时间, 统计列表)
+        self._ratings = None  # (过期时间, 评级字典)
+        self._lock = threading.Lock()
+        # 每次失效递增，防止失效前发起的读取把旧数据写回缓存
+        self._version = 0
+
+    def __getattr__(self, name):
+        return getattr(self._backend, name)
+
+    # ==================== 缓存管理 ====================
+
+    def _get_cached_week(self, year: int, week: int) -> Dict[str, Any]:
+        """取缓存中的周数据（调用方不得修改返回值）"""
+        key = (year, week)
+        with self._lock:
+            entry = self._weeks.get(key)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self._weeks.move_to_end(key)
+                    return entry[1]
+                del self._weeks[key]
+            version = self._version
+
+        data = self._backend.get_week_data(year, week)
+        with self._lock:
+            if version == self._version:
+                self._weeks[key] = (time.monotonic() + self._ttl, data)
+                if len(self._weeks) > self._maxsize:
+                    self._weeks.popitem(last=False)
+        return data
+
+    def invalidate_week(self, year: int, week: int):
+        """使指定周的缓存失效"""
+        with self._lock:
+            self._version += 1
+            self._weeks.pop((year, week), None)
+
+    def clear(self):
+        """清空全部缓存"""
+        with self._lock:
+            self._version += 1
+            self._weeks.clear()
+            self._stats = None
+            self._ratings = None
+
+    # ==================== 周数据读取 ====================
+
+    def get_week_data(self, year: int, week: int) -> Dict[str, Any]:
+        """获取指定周的数据（返回副本，调用方可随意修改）"""
+        return copy.deepcopy(self._get_cached_week(year, week))
+
+    def _get_raw_text(self, year: int, week: int) -> tuple:
+        """获取原始文本"""
+        data = self._get_cached_week(year, week)
+        return data.get('raw_text', ''), copy.deepcopy(data.get('recommender_messages', {}))
+
+    # ==================== 推荐人统计 ====================
+
+    def get_recommender_stats(self) -> List[Dict]:
+        """获取所有推荐人统计（返回副本）"""
+        with self._lock:
+            entry = self._stats
+            version = self._version
+        if entry is not None and entry[0] > time.monotonic():
+            stats = entry[1]
+        else:
+            stats = self._backend.get_recommender_stats()
+            with self._lock:
+                if version == self._version:
+                    self._stats = (time.monotonic() + self._ttl, stats)
+        return copy.deepcopy(stats)
+
+    def get_recommender_ratings(self) -> Dict[str, str]:
+        """获取推荐人评级 {推荐人: 评级}（返回副本）"""
+        with self._lock:
+            entry = self._ratings
+            version = self._version
+        if entry is not None and entry[0] > time.monotonic():
+            ratings = entry[1]
+        else:
+            ratings = self._backend.get_recommender_ratings()
+            with self._lock:
+                if version == self._version:
+                    self._ratings = (time.monotonic() + self._ttl, ratings)
+        return dict(ratings)
+
+    def save_recommender_stats(self, stats_list: List[Dict]):
+        try:
+            return self._backend.save_recommender_stats(stats_list)
+        finally:
+            with self._lock:
+                self._version += 1
+                self._stats = None
+                self._ratings = None
+
+    # ==================== 周数据写入（写库后失效） ====================
+
+    def save_week_data(self, year: int, week: int, stocks: List[Dict],
+                       raw_text: str = '', recommender_messages: Dict = None):
+        try:
+            return self._backend.save_week_data(year, week, stocks, raw_text, recommender_messages)
+        finally:
+            self.invalidate_week(year, week)
+
+    def _save_raw_text(self, year: int, week: int, raw_text: str, recommender_messages: Dict):
+        try:
+            return self._backend._save_raw_text(year, week, raw_text, recommender_messages)
+        finally:
+            self.invalidate_week(year, week)
+
+    def update_stock(self, year: int, week: int, stock_name: str, updates: Dict) -> bool:
+        try:
+            return self._backend.update_stock(year, week, stock_name, updates)
+        finally:
+            self.invalidate_week(year, week)
+
+    def update_stocks(self, year: int, week: int, updates: Dict[str, Dict]) -> int:
+        try:
+            return self._backend.update_stocks(year, week, updates)
+        finally:
+            self.invalidate_week(year, week)
+
+    def update_stock_full(self, year: int, week: int, old_stock_name: str, new_data: Dict) -> bool:
+        try:
+            return self._backend.update_stock_full(year, week, old_stock_name, new_data)
+        finally:
+            self.invalidate_week(year, week)
+
+    def delete_stock(self, year: int, week: int, stock_name: str) -> bool:
+        try:
+            return self._backend.delete_stock(year, week, stock_name)
+        finally:
+            self.invalidate_week(year, week)
+
+    def delete_week(self, year: int, week: int) -> bool:
+        try:
+            return self._backend.delete_week(year, week)
+        finally:
+            self.invalidate_week(year, week)
+
+    def mark_week_tracking_synced(self, year: int, week: int):
+        try:
+            return self._backend.mark_week_tracking_synced(year, week)
+        finally:
+            self.invalidate_week(year, week)
+
+    def reset_week_tracking_sync(self, year: int, week: int) -> int:
+        try:
+            return self._backend.reset_week_tracking_sync(year, week)
+        finally:
+            self.invalidate_week(year, week)
+
+
+# 单例
+_db_instance = None
+
+def get_db() -> CachedDB:
+    global _db_instance
+    if _db_instance is None:
+        _db_instance = CachedDB(MongoDB())
+    return _db_instance
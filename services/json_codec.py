@@ -0,0 +1,27 @@
+"""
+JSON 编码选项
+
+Flask 响应（app.OrjsonProvider）与 Redis 缓存（services.cache）共用，
+保证缓存命中与未命中时同一数据的序列化结果一致；datetime/date 与 Flask 默认一致，输出 RFC 1123（http_date）
+"""
+from decimal import Decimal
+from typing import Any
+
+import orjson
+from bson import ObjectId
+from flask.json.provider import DefaultJSONProvider
+
+# datetime/date 交给 default() 处理，保持原有接口的日期格式（如 'Wed, 14 Oct 2026 05:30:14 GMT'）
+OPTION = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_PASSTHROUGH_DATETIME
+
+
+def default(obj: Any) -> Any:
+    """orjson 无法原生序列化（或交由此处处理）的类型"""
+    if isinstance(obj, (ObjectId, Decimal)):
+        return str(obj)
+    return DefaultJSONProvider.default(obj)
+
+
+def dumps(obj: Any, option: int = 0) -> bytes:
+    """按统一选项序列化，option 为额外选项（如排序键、缩进）"""
+    return orjson.dumps(obj, default=default, option=OPTION | option)
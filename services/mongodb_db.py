@@ -1,16 +1,47 @@
 """
 MongoDB数据操作层
 
-与ExcelDB接口一致，可作为替代数据源
 集合:
   - stock_weekly_batches: 每周推荐数据
   - stock_recommenders: 推荐人统计数据
   - stock_profiles: 股票数据
 """
+import logging
+import threading
 from datetime import datetime
-from typing import List, Dict, Any, Optional
-from pymongo import MongoClient
+from typing import List, Dict, Any, Optional, Tuple
+from pymongo import MongoClient, IndexModel, ReplaceOne, UpdateOne, ASCENDING, DESCENDING
+from pymongo.errors import PyMongoError
 import config
+from services import stock as stock_service
+
+logger = logging.getLogger(__name__)
+
+
+# 股票名称->代码查询缓存有效期（过期后重新查询，以便发现改名）
+STOCK_CODE_CACHE_TTL = 7 * 24 * 3600
+
+# 进程内共享的 MongoClient（按 URI 区分），MongoClient 自带连接池且线程安全
+_clients: Dict[str, MongoClient] = {}
+_clients_lock = threading.Lock()
+
+
+def _get_client(uri: str) -> MongoClient:
+    client = _clients.get(uri)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(uri)
+            if client is None:
+                client = MongoClient(
+                    uri,
+                    maxPoolSize=50,
+                    minPoolSize=5,
+                    # 线路压缩：周数据 stocks 数组等文本较多的文档体积显著减小
+                    compressors='zstd,zlib',
+                    retryWrites=True
+                )
+                _clients[uri] = client
+    return client
 
 
 class MongoDB:
@@ -25,15 +56,40 @@ class MongoDB:
     @property
     def client(self):
         if self._client is None:
-            self._client = MongoClient(self.uri)
+            self._client = _get_client(self.uri)
         return self._client
     
     @property
     def db(self):
         if self._db is None:
             self._db = self.client[self.db_name]
+            self._ensure_indexes()
         return self._db
     
+    def _ensure_indexes(self):
+        """创建常用查询索引（索引已存在时不会重复创建）"""
+        indexes = [
+            # 周数据按 year+week 定位，也用于周列表倒序排序
+            (self.recommendations, [IndexModel([('year', DESCENDING), ('week', DESCENDING)], unique=True)]),
+            (self.tracking, [
+                IndexModel([('market', ASCENDING), ('stock_code', ASCENDING)], unique=True),
+                IndexModel([('updated_at', DESCENDING)]),
+                # 多键索引：按推荐日期定位包含该周推荐的股票
+                IndexModel([('recommendations.time', ASCENDING)])
+            ]),
+            (self.stats, [IndexModel([('name', ASCENDING)], unique=True), IndexModel([('score', DESCENDING)])]),
+            (self.materials, [IndexModel([('linked_stocks.market', ASCENDING), ('linked_stocks.code', ASCENDING)])]),
+            (self.stock_codes, [
+                IndexModel([('query', ASCENDING)], unique=True),
+                IndexModel([('updated_at', ASCENDING)], expireAfterSeconds=STOCK_CODE_CACHE_TTL)
+            ]),
+        ]
+        for collection, models in indexes:
+            try:
+                collection.create_indexes(models)
+            except PyMongoError as e:
+                logger.warning("[MongoDB] 创建索引失败: %s, %s", collection.name, e)
+    
     @property
     def recommendations(self):
         return self.db['stock_weekly_batches']
@@ -49,8 +105,21 @@ class MongoDB:
         doc = self.recommendations.find_one({'year': year, 'week': week})
         if not doc:
             return {'year': year, 'week': week, 'stocks': [], 'raw_text': '', 'recommender_messages': {}}
+        return self._format_week(doc)
+    
+    def get_all_week_data(self, unsynced_only: bool = False) -> Dict[Tuple[int, int], Dict[str, Any]]:
+        """一次查询获取所有周数据，返回 {(year, week): 周数据}，按周倒序
         
-        # 转换格式
+        Args:
+            unsynced_only: 只返回尚未同步到股票跟踪的周
+        """
+        query = {'tracking_synced': {'$ne': True}} if unsynced_only else {}
+        docs = self.recommendations.find(query).sort([('year', -1), ('week', -1)])
+        return {(doc['year'], doc['week']): self._format_week(doc) for doc in docs}
+    
+    @staticmethod
+    def _format_week(doc: Dict) -> Dict[str, Any]:
+        """数据库文档转换为周数据格式"""
         return {
             'year': doc.get('year'),
             'week': doc.get('week'),
@@ -79,30 +148,32 @@ class MongoDB:
     
     def update_stock(self, year: int, week: int, stock_name: str, updates: Dict) -> bool:
         """更新单只股票数据，返回是否成功找到并更新"""
-        # 获取当前数据
-        doc = self.recommendations.find_one({'year': year, 'week': week})
-        if not doc:
-            print(f"[UpdateStock] 未找到周数据: {year}W{week}")
-            return False
-        
-        stocks = doc.get('stocks', [])
-        found = False
-        for stock in stocks:
-            if stock.get('stock_name') == stock_name:
-                stock.update(updates)
-                found = True
-                break
-        
-        if not found:
-            print(f"[UpdateStock] 未找到股票: {stock_name}")
-            return False
-        
-        self.recommendations.update_one(
-            {'year': year, 'week': week},
-            {'$set': {'stocks': stocks, 'updated_at': datetime.now()}}
+        # 位置操作符 $ 原子更新第一只匹配的股票，无需读出整个 stocks 数组
+        set_fields = {f'stocks.$.{k}': v for k, v in updates.items()}
+        set_fields['updated_at'] = datetime.now()
+        result = self.recommendations.update_one(
+            {'year': year, 'week': week, 'stocks.stock_name': stock_name},
+            {'$set': set_fields}
         )
+        if result.matched_count == 0:
+            logger.warning("[UpdateStock] 未找到股票: %sW%s %s", year, week, stock_name)
+            return False
         return True
     
+    def update_stocks(self, year: int, week: int, updates: Dict[str, Dict]) -> int:
+        """批量更新同一周的多只股票 {股票名: 更新字段}，一次往返写库，返回找到并更新的数量"""
+        if not updates:
+            return 0
+        now = datetime.now()
+        result = self.recommendations.bulk_write([
+            UpdateOne(
+                {'year': year, 'week': week, 'stocks.stock_name': stock_name},
+                {'$set': {**{f'stocks.$.{k}': v for k, v in fields.items()}, 'updated_at': now}}
+            )
+            for stock_name, fields in updates.items()
+        ], ordered=False)
+        return result.matched_count
+    
     def mark_week_tracking_synced(self, year: int, week: int):
         """标记周数据已完成股票跟踪同步"""
         self.recommendations.update_one(
@@ -112,15 +183,12 @@ class MongoDB:
     
     def reset_week_tracking_sync(self, year: int, week: int) -> int:
         """重置周同步状态并删除该周的跟踪数据"""
-        from services import stock as stock_service
-        
         # 计算周日期
-        start_date, _ = stock_service.get_week_dates(year, week)
-        date_str = f"{start_date[:4]}-{start_date[4:6]}-{start_date[6:]}"
+        date_str, _ = stock_service.get_week_range(year, week)
         
         # 删除该周的推荐记录（从所有股票中移除该日期的推荐）
         result = self.tracking.update_many(
-            {},
+            {'recommendations.time': date_str},
             {'$pull': {'recommendations': {'time': date_str}}}
         )
         
@@ -140,6 +208,10 @@ class MongoDB:
         ).sort([('year', -1), ('week', -1)])
         return list(docs)
     
+    def count_weeks(self) -> int:
+        """周数据总数"""
+        return self.recommendations.count_documents({})
+    
     def delete_week(self, year: int, week: int) -> bool:
         """删除指定周数据"""
         result = self.recommendations.delete_one({'year': year, 'week': week})
@@ -147,48 +219,29 @@ class MongoDB:
     
     def delete_stock(self, year: int, week: int, stock_name: str) -> bool:
         """删除单只股票"""
-        doc = self.recommendations.find_one({'year': year, 'week': week})
-        if not doc:
-            return False
-        
-        stocks = doc.get('stocks', [])
-        original_len = len(stocks)
-        stocks = [s for s in stocks if s.get('stock_name') != stock_name]
-        
-        if len(stocks) == original_len:
-            return False  # 未找到股票
-        
-        self.recommendations.update_one(
-            {'year': year, 'week': week},
-            {'$set': {'stocks': stocks, 'updated_at': datetime.now()}}
+        result = self.recommendations.update_one(
+            {'year': year, 'week': week, 'stocks.stock_name': stock_name},
+            {
+                '$pull': {'stocks': {'stock_name': stock_name}},
+                '$set': {'updated_at': datetime.now()}
+            }
         )
-        return True
+        return result.modified_count > 0
     
     def update_stock_full(self, year: int, week: int, old_stock_name: str, new_data: Dict) -> bool:
         """完整更新单只股票数据（包括名称）"""
-        doc = self.recommendations.find_one({'year': year, 'week': week})
-        if not doc:
-            return False
-        
-        stocks = doc.get('stocks', [])
-        found = False
-        for stock in stocks:
-            if stock.get('stock_name') == old_stock_name:
-                stock['stock_name'] = new_data.get('stock_name', stock['stock_name'])
-                stock['market'] = new_data.get('market', stock.get('market'))
-                stock['stock_code'] = new_data.get('stock_code', stock.get('stock_code'))
-                stock['recommenders'] = new_data.get('recommenders', stock.get('recommenders', []))
-                found = True
-                break
-        
-        if not found:
-            return False
-        
-        self.recommendations.update_one(
-            {'year': year, 'week': week},
-            {'$set': {'stocks': stocks, 'updated_at': datetime.now()}}
+        # 只更新传入的字段，未传入的保持原值
+        set_fields = {
+            f'stocks.$.{field}': new_data[field]
+            for field in ('stock_name', 'market', 'stock_code', 'recommenders')
+            if field in new_data
+        }
+        set_fields['updated_at'] = datetime.now()
+        result = self.recommendations.update_one(
+            {'year': year, 'week': week, 'stocks.stock_name': old_stock_name},
+            {'$set': set_fields}
         )
-        return True
+        return result.matched_count > 0
     
     # ==================== 原始文本 ====================
     
@@ -218,13 +271,23 @@ class MongoDB:
         docs = self.stats.find({}, {'_id': 0}).sort('score', -1)
         return list(docs)
     
+    def get_recommender_ratings(self) -> Dict[str, str]:
+        """获取推荐人评级 {推荐人: 评级}（只取 name/rating 两个字段）"""
+        docs = self.stats.find({}, {'_id': 0, 'name': 1, 'rating': 1})
+        return {d['name']: d.get('rating', 'D') for d in docs}
+    
     def save_recommender_stats(self, stats_list: List[Dict]):
         """保存推荐人统计（全量覆盖）"""
-        # 删除旧数据
-        self.stats.delete_many({})
-        # 插入新数据
-        if stats_list:
-            self.stats.insert_many(stats_list)
+        if not stats_list:
+            self.stats.delete_many({})
+            return
+        # 按推荐人逐条替换，写入过程中读取方不会看到空集合
+        self.stats.bulk_write(
+            [ReplaceOne({'name': s['name']}, s, upsert=True) for s in stats_list],
+            ordered=False
+        )
+        # 删除已不存在的推荐人
+        self.stats.delete_many({'name': {'$nin': [s['name'] for s in stats_list]}})
     
     # ==================== 股票跟踪 ====================
     
@@ -236,6 +299,36 @@ class MongoDB:
     def materials(self):
         return self.db['stock_materials']
     
+    @property
+    def stock_codes(self):
+        return self.db['stock_code_cache']
+    
+    # ==================== 股票代码缓存 ====================
+    
+    def get_cached_stock_codes(self, names: List[str]) -> Dict[str, Dict]:
+        """批量读取股票代码查询缓存，返回 {查询名: {'market', 'code', 'name'}}"""
+        if not names:
+            return {}
+        docs = self.stock_codes.find(
+            {'query': {'$in': list(names)}},
+            {'_id': 0, 'query': 1, 'market': 1, 'code': 1, 'name': 1}
+        )
+        return {d['query']: {'market': d['market'], 'code': d['code'], 'name': d.get('name')} for d in docs}
+    
+    def save_stock_codes(self, results: Dict[str, Dict]):
+        """写入股票代码查询结果（只应传入查询成功的结果）"""
+        if not results:
+            return
+        now = datetime.now()
+        self.stock_codes.bulk_write([
+            UpdateOne(
+                {'query': query},
+                {'$set': {'market': r['market'], 'code': r['code'], 'name': r.get('name'), 'updated_at': now}},
+                upsert=True
+            )
+            for query, r in results.items()
+        ], ordered=False)
+    
     # ==================== 相关资料 ====================
     
     def get_materials_by_stock(self, market: str, code: str, limit: int = 10) -> List[Dict]:
@@ -247,25 +340,58 @@ class MongoDB:
         ).sort('material_date', -1).limit(limit)
         return list(docs)
     
+    def get_materials_by_stocks(self, keys: List[Tuple[str, str]], limit: int = 10) -> Dict[str, List[Dict]]:
+        """批量获取多只股票的相关资料（一次查询）
+        
+        Args:
+            keys: [(market, code), ...]
+            limit: 每只股票最多返回条数
+        
+        Returns:
+            {"MARKET.code": [资料, ...]}，无资料的股票不出现在结果中
+        """
+        if not keys:
+            return {}
+        conds = [{'market': m, 'code': c} for m, c in keys]
+        docs = self.materials.aggregate([
+            {'$match': {'linked_stocks': {'$elemMatch': {'$or': conds}}}},
+            {'$unwind': '$linked_stocks'},
+            {'$match': {'$or': [{'linked_stocks.market': m, 'linked_stocks.code': c} for m, c in keys]}},
+            # 同一条资料在 linked_stocks 中重复关联同一股票时只保留一次
+            {'$group': {'_id': {'material': '$_id', 'market': '$linked_stocks.market', 'code': '$linked_stocks.code'},
+                        'doc': {'$first': '$$ROOT'}}},
+            {'$replaceRoot': {'newRoot': '$doc'}},
+            {'$sort': {'material_date': -1}},
+            {'$project': {'_id': 0, 'title': 1, 'url': 1, 'description': 1, 'generate_text': 1,
+                          'material_date': 1, 'type': 1, '_key': '$linked_stocks'}},
+            # 只按市场+代码分组，linked_stocks 中其余字段或字段顺序不同不影响分组
+            {'$group': {'_id': {'market': '$_key.market', 'code': '$_key.code'}, 'items': {'$push': '$$ROOT'}}},
+            {'$project': {'items': {'$slice': ['$items', limit]}}},
+            {'$project': {'items._key': 0}}
+        ])
+        return {f"{d['_id']['market']}.{d['_id']['code']}": d['items'] for d in docs}
+    
     def get_all_materials_index(self) -> Dict[str, List[Dict]]:
         """获取所有关联股票的资料索引，用于前端批量匹配"""
-        docs = self.materials.find(
-            {'linked_stocks': {'$ne': None}},
-            {'_id': 0, 'title': 1, 'url': 1, 'linked_stocks': 1, 'material_date': 1}
-        ).sort('material_date', -1)
-        
-        index = {}
-        for doc in docs:
-            for stock in doc.get('linked_stocks', []):
-                key = f"{stock.get('market', '').upper()}.{stock.get('code', '')}"
-                if key not in index:
-                    index[key] = []
-                index[key].append({
-                    'title': doc.get('title'),
-                    'url': doc.get('url'),
-                    'date': doc.get('material_date')
-                })
-        return index
+        # 在服务端按股票分组（先按日期倒序，$push 保持该顺序）
+        docs = self.materials.aggregate([
+            {'$match': {'linked_stocks': {'$ne': None}}},
+            {'$sort': {'material_date': -1}},
+            {'$project': {'_id': 0, 'title': 1, 'url': 1, 'linked_stocks': 1, 'material_date': 1}},
+            {'$unwind': '$linked_stocks'},
+            {'$group': {
+                '_id': {
+                    'market': {'$toUpper': {'$ifNull': ['$linked_stocks.market', '']}},
+                    'code': {'$ifNull': ['$linked_stocks.code', '']}
+                },
+                'items': {'$push': {
+                    'title': {'$ifNull': ['$title', None]},
+                    'url': {'$ifNull': ['$url', None]},
+                    'date': {'$ifNull': ['$material_date', None]}
+                }}
+            }}
+        ], allowDiskUse=True)
+        return {f"{d['_id']['market']}.{d['_id']['code']}": d['items'] for d in docs}
     
     def get_stock_tracking(self, market: str, stock_code: str) -> Optional[Dict]:
         """获取单只股票跟踪数据"""
@@ -274,10 +400,42 @@ class MongoDB:
             doc.pop('_id', None)
         return doc
     
-    def get_all_stock_tracking(self) -> List[Dict]:
-        """获取所有股票跟踪数据"""
-        docs = self.tracking.find({}, {'_id': 0}).sort([('updated_at', -1)])
-        return list(docs)
+    def get_stock_tracking_batch(self, keys: List[Tuple[str, str]]) -> Dict[str, Dict]:
+        """批量获取多只股票跟踪数据（一次查询）
+        
+        Returns:
+            {"MARKET.code": 跟踪数据}，未跟踪的股票不出现在结果中
+        """
+        if not keys:
+            return {}
+        docs = self.tracking.find(
+            {'$or': [{'market': m, 'stock_code': c} for m, c in keys]},
+            {'_id': 0}
+        )
+        return {f"{d['market']}.{d['stock_code']}": d for d in docs}
+    
+    def get_all_stock_tracking(self, summary: bool = False, skip: int = 0, limit: int = 0) -> List[Dict]:
+        """获取所有股票跟踪数据
+        
+        Args:
+            summary: 仅返回列表字段和推荐数量，不含 recommendations 明细
+            skip: 跳过条数
+            limit: 返回条数上限（0 表示不限制）
+        """
+        if not summary:
+            docs = self.tracking.find({}, {'_id': 0}).sort([('updated_at', -1)]).skip(skip).limit(limit)
+            return list(docs)
+        
+        pipeline = [{'$sort': {'updated_at': -1}}]
+        if skip:
+            pipeline.append({'$skip': skip})
+        if limit:
+            pipeline.append({'$limit': limit})
+        pipeline.append({'$project': {
+            '_id': 0, 'market': 1, 'stock_code': 1, 'stock_name': 1, 'updated_at': 1,
+            'recommendations_count': {'$size': {'$ifNull': ['$recommendations', []]}}
+        }})
+        return list(self.tracking.aggregate(pipeline))
     
     def upsert_stock_tracking(self, market: str, stock_code: str, stock_name: str, 
                               recommendation: Dict = None):
@@ -289,60 +447,36 @@ class MongoDB:
             stock_name: 股票名称
             recommendation: 推荐记录 {"time": "2025-12-21", "recommender": "张三", "reason": "..."}
         """
-        # 查找现有记录
-        existing = self.tracking.find_one({'market': market, 'stock_code': stock_code})
+        key = {'market': market, 'stock_code': stock_code}
+        now = datetime.now()
+        update_data = {'stock_name': stock_name, 'updated_at': now}
         
-        if existing:
-            # 更新股票名称
-            update_data = {'stock_name': stock_name, 'updated_at': datetime.now()}
-            
-            # 添加新推荐记录（如果有）
-            if recommendation:
-                # 检查是否已存在相同时间+推荐人的记录
-                existing_recs = existing.get('recommendations', [])
-                is_duplicate = any(
-                    r.get('time') == recommendation.get('time') and 
-                    r.get('recommender') == recommendation.get('recommender')
-                    for r in existing_recs
-                )
-                if not is_duplicate:
-                    self.tracking.update_one(
-                        {'market': market, 'stock_code': stock_code},
-                        {
-                            '$set': update_data,
-                            '$push': {'recommendations': recommendation}
-                        }
-                    )
-                    return
-            
-            self.tracking.update_one(
-                {'market': market, 'stock_code': stock_code},
-                {'$set': update_data}
+        if recommendation:
+            # 已有记录且不存在相同时间+推荐人的推荐时追加（去重在服务端判断）
+            result = self.tracking.update_one(
+                {**key, 'recommendations': {'$not': {'$elemMatch': {
+                    'time': recommendation.get('time'),
+                    'recommender': recommendation.get('recommender')
+                }}}},
+                {'$set': update_data, '$push': {'recommendations': recommendation}}
             )
-        else:
-            # 新建记录
-            doc = {
-                'market': market,
-                'stock_code': stock_code,
-                'stock_name': stock_name,
-                'recommendations': [recommendation] if recommendation else [],
-                'created_at': datetime.now(),
-                'updated_at': datetime.now()
-            }
-            self.tracking.insert_one(doc)
+            if result.matched_count:
+                return
+        
+        # 新建记录；已有记录（推荐重复或无推荐）则只更新股票名称
+        self.tracking.update_one(
+            key,
+            {
+                '$set': update_data,
+                '$setOnInsert': {
+                    'recommendations': [recommendation] if recommendation else [],
+                    'created_at': now
+                }
+            },
+            upsert=True
+        )
     
     def clear_stock_tracking(self):
         """清空股票跟踪集合"""
         result = self.tracking.delete_many({})
         return result.deleted_count
-
-
-# 单例
-_db_instance = None
-
-
-def get_db():
-    global _db_instance
-    if _db_instance is None:
-        _db_instance = MongoDB()
-    return _db_instance
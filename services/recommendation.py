@@ -4,13 +4,93 @@
 提供推荐文本解析、股票代码填充、K线获取、推荐人统计计算
 """
 import re
+import heapq
+import logging
+import threading
+import traceback
+import numpy as np
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from operator import itemgetter
 from typing import Dict, Any, List, Tuple
 from datetime import datetime
-from services.mongodb_db import get_db
+from services.cache_db import get_db
 from services import stock as stock_service
 import config
 
+logger = logging.getLogger(__name__)
+
+# 并发获取K线的线程数（各行情源另有并发上限）
+KLINE_WORKERS = 16
+# Gemini 接口共享会话（首次调用时创建），复用 keep-alive 连接
+# 仅重试连接失败，POST 已发出后不重复提交
+_gemini_session = None
+_gemini_session_lock = threading.Lock()
+
+
+def _get_gemini_session() -> requests.Session:
+    global _gemini_session
+    if _gemini_session is None:
+        with _gemini_session_lock:
+            if _gemini_session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32,
+                                      max_retries=Retry(total=2, backoff_factor=0.3))
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _gemini_session = session
+    return _gemini_session
+
+
+# Gemini 返回内容可能被 ```json ... ``` 代码块包裹
+_FENCE_RE = re.compile(r'^\s*```[\w-]*\s*|\s*```\s*$')
+
+
+def _loads_content(content: str) -> Any:
+    """解析 Gemini 返回的 JSON 文本，兼容 markdown 代码块包裹"""
+    return orjson.loads(_FENCE_RE.sub('', content))
+
+
+def _post_gemini(text: str, prompt: str, response_format: Dict) -> str:
+    """调用主系统Gemini API（结构化输出），返回 content 文本
+    
+    主系统接口: POST /api/gemini/generate/text
+    请求体: {"text": "输入文本", "prompt": "提示词"}
+    响应: {"errcode": 0, "content": "..."}
+    
+    Raises:
+        Exception: HTTP 状态码异常或 errcode 非0
+    """
+    resp = _get_gemini_session().post(
+        config.GEMINI_API_URL,
+        json={
+            'text': text,
+            'prompt': prompt,
+            'use_structured_response': True,
+            'response_format': response_format
+        },
+        headers={'Token': config.GEMINI_API_TOKEN},
+        timeout=600
+    )
+    
+    if resp.status_code != 200:
+        raise Exception(f"Gemini API错误: {resp.status_code}, {resp.text}")
+    
+    # 预览只截取响应原文，不再把整个结果重新序列化一遍
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("[Gemini] API响应: %s", resp.content[:500].decode('utf-8', errors='ignore'))
+    result = orjson.loads(resp.content)
+    
+    if result.get('errcode', 0) != 0:
+        raise Exception(f"Gemini API错误: {result.get('msg', '未知错误')}")
+    
+    # content直接在顶级，不是在data里
+    return result.get('content', '')
+
 
 class RecommendationService:
     """推荐服务"""
@@ -28,8 +108,6 @@ class RecommendationService:
     
     def parse_with_gemini(self, year: int, week: int) -> Dict[str, Any]:
         """调用Gemini API解析推荐文本"""
-        import traceback
-        
         # 获取原始文本
         raw_text, _ = self.db._get_raw_text(year, week)
         if not raw_text:
@@ -38,17 +116,17 @@ class RecommendationService:
         # 调用主系统Gemini API
         try:
             prompt = self._build_parse_prompt(raw_text)
-            print(f"[Gemini] 开始解析 {year}年第{week}周, 文本长度: {len(raw_text)}")
+            logger.info("[Gemini] 开始解析 %s年第%s周, 文本长度: %s", year, week, len(raw_text))
             
             parsed_items = self._call_gemini_api(raw_text, prompt)
-            print(f"[Gemini] 解析结果: {len(parsed_items)} 条记录")
+            logger.info("[Gemini] 解析结果: %s 条记录", len(parsed_items))
             
             if not parsed_items:
                 return {'error': 'Gemini返回空结果，请检查原始文本格式'}
             
             # 合并相同股票
             merged, recommender_messages = self._merge_recommendations(parsed_items)
-            print(f"[Gemini] 合并后: {len(merged)} 只股票, {len(recommender_messages)} 位推荐人")
+            logger.info("[Gemini] 合并后: %s 只股票, %s 位推荐人", len(merged), len(recommender_messages))
             
             # 构建股票列表
             stocks = []
@@ -59,9 +137,9 @@ class RecommendationService:
                     'status': 'pending'
                 })
             
-            # 保存到Excel
+            # 保存周数据
             self.db.save_week_data(year, week, stocks, raw_text, recommender_messages)
-            print(f"[Gemini] 保存成功: {len(stocks)} 只股票")
+            logger.info("[Gemini] 保存成功: %s 只股票", len(stocks))
             
             return {
                 'year': year, 
@@ -71,8 +149,8 @@ class RecommendationService:
             }
             
         except Exception as e:
+            logger.exception("[Gemini] 解析失败")
             error_detail = traceback.format_exc()
-            print(f"[Gemini] 解析失败:\n{error_detail}")
             return {'error': f"{str(e)}\n\n详细信息:\n{error_detail}"}
     
     def _build_parse_prompt(self, raw_text: str) -> str:
@@ -91,45 +169,18 @@ class RecommendationService:
 7. 保留推荐人的原始完整消息（去掉序号前缀）"""
     
     def _call_gemini_api(self, text: str, prompt: str) -> List[Dict]:
-        """调用主系统Gemini API
-        
-        主系统接口: POST /api/gemini/generate/text
-        请求体: {"text": "输入文本", "prompt": "提示词"}
-        响应: {"errcode": 0, "data": {"content": "..."}}
-        """
-        import json
-        
+        """调用Gemini解析推荐文本，返回展开后的 [{recommender, stock, original}]"""
         if not config.GEMINI_API_TOKEN:
             raise ValueError("未配置GEMINI_API_TOKEN")
         
-        
-        resp = requests.post(
-            config.GEMINI_API_URL,
-            json={
-                'text': text,
-                'prompt': prompt,
-                'use_structured_response': True,
-                'response_format': {"items": [{"name": "推荐人", "stocks": "股票1 股票2", "original": "原始推荐消息"}]}
-            },
-            headers={'Token': config.GEMINI_API_TOKEN},
-            timeout=600
+        content = _post_gemini(
+            text, prompt,
+            {"items": [{"name": "推荐人", "stocks": "股票1 股票2", "original": "原始推荐消息"}]}
         )
         
-        if resp.status_code != 200:
-            raise Exception(f"Gemini API错误: {resp.status_code}, {resp.text}")
-        
-        result = resp.json()
-        print(f"[Gemini] API响应: {json.dumps(result, ensure_ascii=False)[:500]}")
-        
-        if result.get('errcode', 0) != 0:
-            raise Exception(f"Gemini API错误: {result.get('msg', '未知错误')}")
-        
-        # content直接在顶级，不是在data里
-        content = result.get('content', '')
-        
         # 解析JSON并展开（与原系统一致）
         try:
-            parsed = json.loads(content)
+            parsed = _loads_content(content)
             items = parsed.get('items', []) if isinstance(parsed, dict) else parsed
             
             # 展开：每个股票一条记录
@@ -146,33 +197,32 @@ class RecommendationService:
                                 'stock': stock.strip(),
                                 'original': original
                             })
-            print(f"[Gemini] 展开后: {len(expanded)} 条记录")
+            logger.info("[Gemini] 展开后: %s 条记录", len(expanded))
             return expanded
-        except json.JSONDecodeError as e:
-            print(f"[Gemini] JSON解析失败: {e}, 内容: {content[:500]}")
+        except orjson.JSONDecodeError as e:
+            logger.warning("[Gemini] JSON解析失败: %s, 内容: %s", e, content[:500])
             return []
     
     def _merge_recommendations(self, items: List[Dict]) -> Tuple[Dict, Dict]:
         """合并相同股票的推荐（与原系统一致）"""
-        merged = {}  # stock -> set of recommenders
+        merged = defaultdict(set)  # stock -> set of recommenders
         recommender_messages = {}  # recommender -> original message
         
         for item in items:
             recommender = item.get('recommender', '').strip()
             stock = item.get('stock', '').strip()
-            original = item.get('original', '').strip()
+            if not recommender or not stock:
+                continue
             
-            if recommender and stock:
-                if stock not in merged:
-                    merged[stock] = set()
-                merged[stock].add(recommender)
-                
-                # 保存推荐人原始消息（只保存第一次出现的），剔除开头的推荐人名字
-                if recommender and original and recommender not in recommender_messages:
-                    msg = original
-                    if msg.startswith(recommender):
-                        msg = msg[len(recommender):].lstrip(' :：\t')
-                    recommender_messages[recommender] = msg
+            merged[stock].add(recommender)
+            
+            # 保存推荐人原始消息（只保存第一次出现的），剔除开头的推荐人名字
+            if recommender not in recommender_messages:
+                original = item.get('original', '').strip()
+                if original:
+                    if original.startswith(recommender):
+                        original = original[len(recommender):].lstrip(' :：\t')
+                    recommender_messages[recommender] = original
         
         return merged, recommender_messages
     
@@ -183,48 +233,56 @@ class RecommendationService:
         data = self.db.get_week_data(year, week)
         stocks = data.get('stocks', [])
         
-        print(f"[ResolveCode] 开始解析 {year}年第{week}周, 共 {len(stocks)} 只股票")
+        logger.info("[ResolveCode] 开始解析 %s年第%s周, 共 %s 只股票", year, week, len(stocks))
         
-        # 第一步：按股票名称去重，合并推荐人
-        name_map = {}  # key: stock_name, value: stock dict
+        # 第一步：按股票名称去重，合并推荐人（保留首条记录，推荐人按顺序去重追加）
+        name_map = {}  # stock_name -> (首条股票字典, 推荐人集合)
         for stock in stocks:
             stock_name = stock.get('stock_name', '')
             if not stock_name:
                 continue
             
-            if stock_name not in name_map:
-                name_map[stock_name] = stock.copy()
+            entry = name_map.get(stock_name)
+            if entry is None:
+                # get_week_data 返回的是副本，直接复用首次出现的股票字典
+                recommenders = list(dict.fromkeys(stock.get('recommenders', [])))
+                stock['recommenders'] = recommenders
+                name_map[stock_name] = (stock, set(recommenders))
             else:
                 # 合并推荐人
-                existing = name_map[stock_name]
-                existing_recommenders = set(existing.get('recommenders', []))
-                new_recommenders = set(stock.get('recommenders', []))
-                existing['recommenders'] = list(existing_recommenders | new_recommenders)
+                existing, names = entry
+                for name in stock.get('recommenders', []):
+                    if name not in names:
+                        names.add(name)
+                        existing['recommenders'].append(name)
                 # 如果已有代码，保留
                 if stock.get('market') and stock.get('stock_code'):
                     existing['market'] = stock['market']
                     existing['stock_code'] = stock['stock_code']
                     existing['status'] = stock.get('status', 'resolved')
         
-        # 转回列表
-        stocks = list(name_map.values())
+        stocks = [stock for stock, _ in name_map.values()]
         name_dedup_count = len(data.get('stocks', [])) - len(stocks)
         if name_dedup_count > 0:
-            print(f"[ResolveCode] 按名称去重: 合并 {name_dedup_count} 条重复记录")
+            logger.info("[ResolveCode] 按名称去重: 合并 %s 条重复记录", name_dedup_count)
         
         success = 0
         error = 0
         
+        # 并发查询所有缺少代码的股票
+        pending = [s for s in stocks if not (s.get('market') and s.get('stock_code'))]
+        search_results = self._search_stocks([s.get('stock_name', '') for s in pending])
+        
         for stock in stocks:
             stock_name = stock.get('stock_name', '')
-            print(f"[ResolveCode] 处理: {stock_name}, 已有market={stock.get('market')}, code={stock.get('stock_code')}")
+            logger.debug("[ResolveCode] 处理: %s, 已有market=%s, code=%s", stock_name, stock.get('market'), stock.get('stock_code'))
             
             if stock.get('market') and stock.get('stock_code'):
-                print(f"[ResolveCode] 跳过: {stock_name} (已有代码)")
+                logger.debug("[ResolveCode] 跳过: %s (已有代码)", stock_name)
                 continue  # 已有代码
             
-            result = stock_service.search_stock(stock_name)
-            print(f"[ResolveCode] 搜索结果: {stock_name} -> {result}")
+            result = search_results.get(stock_name)
+            logger.debug("[ResolveCode] 搜索结果: %s -> %s", stock_name, result)
             
             if result:
                 stock['market'] = result['market']
@@ -232,40 +290,17 @@ class RecommendationService:
                 stock['status'] = 'resolved'
                 # 如果返回了正确的股票名，则矫正
                 if result.get('name') and result['name'] != stock_name:
-                    print(f"[ResolveCode] 矫正股票名: {stock_name} -> {result['name']}")
+                    logger.debug("[ResolveCode] 矫正股票名: %s -> %s", stock_name, result['name'])
                     stock['stock_name'] = result['name']
                 success += 1
             else:
                 error += 1
         
         # 第二步：按市场+代码去重合并
-        code_map = {}  # key: "market_code", value: stock dict
-        for stock in stocks:
-            market = stock.get('market', '')
-            code = stock.get('stock_code', '')
-            
-            if not market or not code:
-                # 没有代码的股票直接保留
-                key = f"_no_code_{stock.get('stock_name', '')}"
-                code_map[key] = stock
-                continue
-            
-            key = f"{market}_{code}"
-            
-            if key not in code_map:
-                code_map[key] = stock
-            else:
-                # 合并推荐人
-                existing = code_map[key]
-                existing_recommenders = set(existing.get('recommenders', []))
-                new_recommenders = set(stock.get('recommenders', []))
-                existing['recommenders'] = list(existing_recommenders | new_recommenders)
-        
-        # 转回列表
-        merged_stocks = list(code_map.values())
+        merged_stocks = self._merge_by_code(stocks)
         code_dedup_count = len(stocks) - len(merged_stocks)
         if code_dedup_count > 0:
-            print(f"[ResolveCode] 按代码去重: 合并 {code_dedup_count} 条重复记录")
+            logger.info("[ResolveCode] 按代码去重: 合并 %s 条重复记录", code_dedup_count)
         
         # 保存最终结果
         self.db.save_week_data(
@@ -275,67 +310,80 @@ class RecommendationService:
         )
         
         merged_count = name_dedup_count + code_dedup_count
-        print(f"[ResolveCode] 完成: success={success}, error={error}, merged={merged_count}")
+        logger.info("[ResolveCode] 完成: success=%s, error=%s, merged=%s", success, error, merged_count)
         return {'success': success, 'error': error, 'merged': merged_count}
     
-    def _merge_duplicate_stocks(self, year: int, week: int) -> int:
-        """合并相同市场+代码的股票"""
-        data = self.db.get_week_data(year, week)
-        stocks = data.get('stocks', [])
+    def _search_stocks(self, names: List[str]) -> Dict[str, Any]:
+        """查询股票代码，返回 {股票名: search_stock结果}
         
-        # 按 market+code 分组
-        stock_map = {}  # key: "market_code", value: {"stock": merged_stock, "indices": [原始索引]}
+        先查数据库中的查询缓存（跨周、跨进程复用，7天过期），未命中的再批量请求接口
+        """
+        names = list(dict.fromkeys(n for n in names if n))
+        if not names:
+            return {}
         
-        for i, stock in enumerate(stocks):
+        results = self.db.get_cached_stock_codes(names)
+        misses = [n for n in names if n not in results]
+        if not misses:
+            return results
+        
+        fetched = stock_service.search_stocks_bulk(misses)
+        
+        # 只缓存查询成功的结果，失败可能是网络异常
+        self.db.save_stock_codes({n: r for n, r in fetched.items() if r})
+        results.update(fetched)
+        return results
+    
+    @staticmethod
+    def _merge_by_code(stocks: List[Dict]) -> List[Dict]:
+        """按市场+代码合并重复股票（合并推荐人），没有代码的股票原样保留
+        
+        单次遍历，保留每个代码首次出现的记录，后续重复记录的推荐人按顺序去重追加
+        会直接修改传入的股票字典，返回的列表中 recommenders 为列表
+        """
+        merged_stocks = []
+        seen = {}  # (market, code) -> (首条记录的推荐人列表, 推荐人集合)
+        for stock in stocks:
             market = stock.get('market', '')
             code = stock.get('stock_code', '')
             
             if not market or not code:
-                continue  # 跳过没有代码的
+                # 没有代码的股票直接保留
+                merged_stocks.append(stock)
+                continue
             
-            key = f"{market}_{code}"
+            entry = seen.get((market, code))
+            if entry is None:
+                recommenders = list(dict.fromkeys(stock.get('recommenders', [])))
+                stock['recommenders'] = recommenders
+                seen[(market, code)] = (recommenders, set(recommenders))
+                merged_stocks.append(stock)
+                continue
             
-            if key not in stock_map:
-                stock_map[key] = {'stock': stock.copy(), 'indices': [i]}
-            else:
-                # 合并推荐人
-                existing = stock_map[key]['stock']
-                existing_recommenders = set(existing.get('recommenders', []))
-                new_recommenders = set(stock.get('recommenders', []))
-                merged_recommenders = list(existing_recommenders | new_recommenders)
-                existing['recommenders'] = merged_recommenders
-                stock_map[key]['indices'].append(i)
-        
-        # 检查是否有重复
-        duplicates = [v for v in stock_map.values() if len(v['indices']) > 1]
+            # 合并推荐人
+            recommenders, names = entry
+            for name in stock.get('recommenders', []):
+                if name not in names:
+                    names.add(name)
+                    recommenders.append(name)
+        return merged_stocks
+    
+    def _merge_duplicate_stocks(self, year: int, week: int) -> int:
+        """合并已保存周数据中相同市场+代码的股票，无重复时不写库"""
+        data = self.db.get_week_data(year, week)
+        stocks = data.get('stocks', [])
         
-        if not duplicates:
+        new_stocks = self._merge_by_code(stocks)
+        merged_count = len(stocks) - len(new_stocks)
+        if not merged_count:
             return 0
         
-        # 构建新的股票列表
-        indices_to_remove = set()
-        for dup in duplicates:
-            # 保留第一个，移除其他
-            for idx in dup['indices'][1:]:
-                indices_to_remove.add(idx)
-        
-        # 更新第一个股票的推荐人
-        for dup in duplicates:
-            first_idx = dup['indices'][0]
-            stocks[first_idx]['recommenders'] = dup['stock']['recommenders']
-        
-        # 移除重复项
-        new_stocks = [s for i, s in enumerate(stocks) if i not in indices_to_remove]
-        
-        # 保存
         self.db.save_week_data(
             year, week, new_stocks,
             data.get('raw_text', ''),
             data.get('recommender_messages', {})
         )
-        
-        merged_count = len(indices_to_remove)
-        print(f"[ResolveCode] 去重合并: 移除 {merged_count} 条重复记录")
+        logger.info("[ResolveCode] 去重合并: 移除 %s 条重复记录", merged_count)
         return merged_count
     
     # ==================== K线数据 ====================
@@ -348,65 +396,78 @@ class RecommendationService:
         success = 0
         error = 0
         
+        targets = []
         for stock in stocks:
-            market = stock.get('market')
-            code = stock.get('stock_code')
-            
-            if not market or not code:
-                print(f"[FetchKline] 跳过无代码: {stock.get('stock_name')}")
+            if not stock.get('market') or not stock.get('stock_code'):
+                logger.debug("[FetchKline] 跳过无代码: %s", stock.get('stock_name'))
                 error += 1
                 continue
-            
-            try:
-                kline = stock_service.get_kline(market, code, year, week)
-                if kline:
-                    updated = self.db.update_stock(year, week, stock['stock_name'], {
-                        'open_price': kline['open_price'],
-                        'close_price': kline['close_price'],
-                        'change_pct': kline['change_pct'],
-                        'status': 'completed'
-                    })
-                    if updated:
-                        success += 1
+            targets.append(stock)
+        
+        # 并发请求行情接口，结果汇总后一次批量写库
+        updates = {}
+        with ThreadPoolExecutor(max_workers=KLINE_WORKERS) as executor:
+            futures = {
+                executor.submit(stock_service.get_kline, s['market'], s['stock_code'], year, week): s
+                for s in targets
+            }
+            for future in as_completed(futures):
+                stock = futures[future]
+                market = stock['market']
+                code = stock['stock_code']
+                try:
+                    kline = future.result()
+                    if kline:
+                        updates[stock['stock_name']] = {
+                            'open_price': kline['open_price'],
+                            'close_price': kline['close_price'],
+                            'change_pct': kline['change_pct'],
+                            'status': 'completed'
+                        }
                     else:
-                        print(f"[FetchKline] 更新失败: {stock['stock_name']} (数据库未找到)")
+                        logger.warning("[FetchKline] K线为空: %s.%s %s", market, code, stock.get('stock_name'))
                         error += 1
-                else:
-                    print(f"[FetchKline] K线为空: {market}.{code} {stock.get('stock_name')}")
+                except Exception as e:
+                    logger.warning("[FetchKline] 异常: %s.%s %s - %s", market, code, stock.get('stock_name'), e)
                     error += 1
-            except Exception as e:
-                print(f"[FetchKline] 异常: {market}.{code} {stock.get('stock_name')} - {e}")
-                error += 1
-            
-            import time
-            time.sleep(0.3)
         
-        print(f"[FetchKline] 完成: success={success}, error={error}")
+        updated = self.db.update_stocks(year, week, updates)
+        success += updated
+        if updated < len(updates):
+            logger.warning("[FetchKline] 更新失败: %s 只股票数据库未找到", len(updates) - updated)
+            error += len(updates) - updated
+        
+        logger.info("[FetchKline] 完成: success=%s, error=%s", success, error)
         return {'success': success, 'error': error}
     
     # ==================== 排行榜 ====================
     
-    def get_ranking(self, year: int, week: int) -> Dict[str, Any]:
-        """获取排行榜数据"""
+    def get_ranking(self, year: int, week: int, limit: int = None) -> Dict[str, Any]:
+        """获取排行榜数据
+        
+        Args:
+            limit: 只返回前N名（None 返回全部）
+        """
         data = self.db.get_week_data(year, week)
         stocks = data.get('stocks', [])
         
         # 获取推荐人评级
-        stats = self.db.get_recommender_stats()
-        ratings = {s['name']: s.get('rating', 'D') for s in stats}
+        ratings = self.db.get_recommender_ratings()
         
         # 分离有涨跌幅和无涨跌幅的股票
         with_pct = [s for s in stocks if s.get('change_pct') is not None]
         without_pct = [s for s in stocks if s.get('change_pct') is None]
         
-        # 有涨跌幅的按涨跌幅排序，无涨跌幅的接在后面
-        sorted_with_pct = sorted(with_pct, key=lambda x: x.get('change_pct', 0), reverse=True)
-        sorted_stocks = sorted_with_pct + without_pct
+        # 有涨跌幅的按涨跌幅排序，无涨跌幅的接在后面；只取前N名时用堆选出，不做全量排序
+        by_pct = itemgetter('change_pct')
+        if limit:
+            sorted_stocks = heapq.nlargest(limit, with_pct, key=by_pct)
+            sorted_stocks += without_pct[:limit - len(sorted_stocks)]
+        else:
+            sorted_stocks = sorted(with_pct, key=by_pct, reverse=True) + without_pct
         
         # 计算周日期范围
-        start_date, end_date = stock_service.get_week_dates(year, week)
-        week_start = f"{start_date[:4]}-{start_date[4:6]}-{start_date[6:]}"
-        week_end = f"{end_date[:4]}-{end_date[4:6]}-{end_date[6:]}"
+        week_start, week_end = stock_service.get_week_range(year, week)
         
         return {
             'stocks': sorted_stocks,
@@ -421,128 +482,137 @@ class RecommendationService:
     
     def calculate_recommender_stats(self) -> Dict[str, Any]:
         """计算推荐人统计"""
-        weeks = self.db.get_all_weeks()
+        # 一次查询读出全部周数据（按周倒序，明细按此顺序收集即为倒序，无需再排序）
+        all_weeks = self.db.get_all_week_data()
         
-        # 收集所有推荐人数据
-        recommender_data = {}  # name -> {weeks: {(y,w): [returns]}, details: []}
+        # 一次遍历收集为并列数组：推荐人序号、周序号（year*100+week）、涨跌幅
+        rec_index = {}  # 推荐人 -> 序号（按首次出现顺序）
+        rec_details = []  # 序号 -> [(year, week, stock_name, change_pct), ...]
+        rec_idx, week_ord, pct = [], [], []
         
-        for w in weeks:
-            data = self.db.get_week_data(w['year'], w['week'])
+        for (year, week), data in all_weeks.items():
+            week_no = year * 100 + week
             for stock in data.get('stocks', []):
                 change_pct = stock.get('change_pct')
                 if change_pct is None:
                     continue
                 
+                stock_name = stock['stock_name']
                 for recommender in stock.get('recommenders', []):
-                    if recommender not in recommender_data:
-                        recommender_data[recommender] = {'weeks': {}, 'details': []}
-                    
-                    week_key = (w['year'], w['week'])
-                    if week_key not in recommender_data[recommender]['weeks']:
-                        recommender_data[recommender]['weeks'][week_key] = []
-                    
-                    recommender_data[recommender]['weeks'][week_key].append(change_pct)
-                    recommender_data[recommender]['details'].append({
-                        'year': w['year'],
-                        'week': w['week'],
-                        'stock_name': stock['stock_name'],
-                        'change_pct': change_pct
-                    })
-        
-        # 计算统计
+                    i = rec_index.get(recommender)
+                    if i is None:
+                        i = rec_index[recommender] = len(rec_details)
+                        rec_details.append([])
+                    rec_idx.append(i)
+                    week_ord.append(week_no)
+                    pct.append(change_pct)
+                    rec_details[i].append((year, week, stock_name, change_pct))
+        
+        names = list(rec_index)
+        pct = np.asarray(pct, dtype=np.float64)
+        
+        # 按 (推荐人, 周) 分组，分组结果按推荐人、周升序排列
+        # bincount 按原顺序依次累加，与逐个求和结果一致
+        group_key = np.asarray(rec_idx, dtype=np.int64) * 1000000 + np.asarray(week_ord, dtype=np.int64)
+        group_keys, group_id = np.unique(group_key, return_inverse=True)
+        group_cnt = np.bincount(group_id)
+        group_win = np.bincount(group_id, weights=pct > 0).astype(np.int64)
+        group_avg = np.bincount(group_id, weights=pct) / group_cnt
+        group_rec = group_keys // 1000000
+        group_week = group_keys % 1000000
+        
+        # 每个推荐人的汇总
+        n = len(names)
+        rec_start = np.searchsorted(group_rec, np.arange(n + 1))
+        rec_count = np.bincount(group_rec, weights=group_cnt, minlength=n).astype(np.int64)
+        rec_win = np.bincount(group_rec, weights=group_win, minlength=n).astype(np.int64)
+        rec_avg_sum = np.bincount(group_rec, weights=group_avg, minlength=n)
+        rec_pos = np.bincount(group_rec, weights=group_avg > 0, minlength=n).astype(np.int64)
+        rec_neg = np.bincount(group_rec, weights=group_avg < 0, minlength=n).astype(np.int64)
+        growth = 1 + group_avg / 100
+        
+        # 各推荐人的净值曲线（逐周累乘）
+        net_curves = [np.cumprod(growth[rec_start[i]:rec_start[i + 1]]) for i in range(n)]
+        net_value = np.array([curve[-1] for curve in net_curves], dtype=np.float64)
+        
+        # 基础指标（每个推荐人至少有一周数据，分母不为0）
+        total_weeks = np.diff(rec_start)
+        total_return = (net_value - 1) * 100
+        avg_return = rec_avg_sum / total_weeks
+        win_rate = rec_win / rec_count * 100
+        weekly_win_rate = rec_pos / total_weeks * 100
+        
+        # 评分计算
+        win_rate_score = np.minimum(win_rate, 100)
+        return_score = np.clip(total_return + 50, 0, 100)
+        avg_score = np.clip((avg_return + 5) * 10, 0, 100)
+        weeks_score = np.where(total_weeks >= 3, np.minimum(total_weeks / 6 * 100, 100), total_weeks / 3 * 50)
+        count_score = np.where(rec_count >= 5, np.minimum(rec_count / 15 * 100, 100), rec_count / 5 * 50)
+        
+        # 连续性加分：满4周才计算，全胜/全负按周数递增，否则按胜负周占比
+        weeks_bonus = np.select(
+            [total_weeks < 4, rec_pos == total_weeks, rec_neg == total_weeks, rec_neg > rec_pos],
+            [0.0,
+             np.minimum(75 + (total_weeks - 4) * 5, 100),
+             np.maximum(-50 - (total_weeks - 4) * 5, -100),
+             -(rec_neg / total_weeks) * 50],
+            (rec_pos / total_weeks) * 50
+        )
+        
+        confidence = np.minimum(total_weeks / 2, 1.0)
+        raw_score = (
+            win_rate_score * 0.22 +
+            return_score * 0.23 +
+            avg_score * 0.15 +
+            weeks_score * 0.10 +
+            count_score * 0.10 +
+            weeks_bonus * 0.20
+        )
+        # 用 Python round 保持与逐个计算时完全相同的舍入
+        scores = [round(x, 1) for x in (50 + (raw_score - 50) * confidence).tolist()]
+        ratings = np.array(list('DCBAS'))[np.digitize(scores, [25, 45, 65, 80])].tolist() if n else []
+        
+        # 组装结果
         result = []
-        for name, data in recommender_data.items():
-            weekly_returns = []
-            net_value = 1.0
-            total_count = 0
-            win_count = 0
-            
-            sorted_weeks = sorted(data['weeks'].keys())
-            weekly_returns_list = []
-            
-            for week_key in sorted_weeks:
-                week_returns = data['weeks'][week_key]
-                week_avg = sum(week_returns) / len(week_returns)
-                weekly_returns.append(week_avg)
-                net_value *= (1 + week_avg / 100)
-                
-                weekly_returns_list.append({
-                    'year': week_key[0],
-                    'week': week_key[1],
-                    'return': round(week_avg, 2),
-                    'net_value': round(net_value, 4),
-                    'stock_count': len(week_returns)
-                })
-                
-                total_count += len(week_returns)
-                win_count += sum(1 for r in week_returns if r > 0)
-            
-            total_return = (net_value - 1) * 100
-            avg_return = sum(weekly_returns) / len(weekly_returns) if weekly_returns else 0
-            win_rate = (win_count / total_count * 100) if total_count > 0 else 0
-            positive_weeks = sum(1 for r in weekly_returns if r > 0)
-            negative_weeks = sum(1 for r in weekly_returns if r < 0)
-            total_weeks = len(weekly_returns)
-            
-            # 评分计算
-            win_rate_score = min(win_rate, 100)
-            return_score = min(max(total_return + 50, 0), 100)
-            avg_score = min(max((avg_return + 5) * 10, 0), 100)
-            weeks_score = min(total_weeks / 6 * 100, 100) if total_weeks >= 3 else total_weeks / 3 * 50
-            count_score = min(total_count / 15 * 100, 100) if total_count >= 5 else total_count / 5 * 50
-            
-            weeks_bonus = 0
-            if total_weeks >= 4:
-                if positive_weeks == total_weeks:
-                    weeks_bonus = min(75 + (total_weeks - 4) * 5, 100)
-                elif negative_weeks == total_weeks:
-                    weeks_bonus = max(-50 - (total_weeks - 4) * 5, -100)
-                elif negative_weeks > positive_weeks:
-                    weeks_bonus = -(negative_weeks / total_weeks) * 50
-                else:
-                    weeks_bonus = (positive_weeks / total_weeks) * 50
-            
-            confidence = min(total_weeks / 2, 1.0)
-            raw_score = (
-                win_rate_score * 0.22 +
-                return_score * 0.23 +
-                avg_score * 0.15 +
-                weeks_score * 0.10 +
-                count_score * 0.10 +
-                weeks_bonus * 0.20
-            )
-            score = round(50 + (raw_score - 50) * confidence, 1)
-            
-            if score >= 80:
-                rating = "S"
-            elif score >= 65:
-                rating = "A"
-            elif score >= 45:
-                rating = "B"
-            elif score >= 25:
-                rating = "C"
-            else:
-                rating = "D"
-            
-            weekly_win_rate = (positive_weeks / total_weeks * 100) if total_weeks > 0 else 0
+        columns = zip(names, total_weeks.tolist(), rec_count.tolist(), rec_win.tolist(), rec_pos.tolist(),
+                      win_rate.tolist(), weekly_win_rate.tolist(), total_return.tolist(), avg_return.tolist(),
+                      scores, ratings)
+        for i, (name, weeks_count, total_count, win_count, positive_weeks, win_rate_i, weekly_win_rate_i,
+                total_return_i, avg_return_i, score, rating) in enumerate(columns):
+            lo, hi = rec_start[i], rec_start[i + 1]
+            weekly_returns_list = [
+                {
+                    'year': wk // 100,
+                    'week': wk % 100,
+                    'return': round(avg, 2),
+                    'net_value': round(nv, 4),
+                    'stock_count': cnt
+                }
+                for wk, avg, nv, cnt in zip(group_week[lo:hi].tolist(), group_avg[lo:hi].tolist(),
+                                            net_curves[i].tolist(), group_cnt[lo:hi].tolist())
+            ]
+            # 分组按周升序，反转一次即为倒序
+            weekly_returns_list.reverse()
             
-            sorted_details = sorted(data['details'], key=lambda x: (x['year'], x['week']), reverse=True)
-            sorted_weekly = sorted(weekly_returns_list, key=lambda x: (x['year'], x['week']), reverse=True)
+            details = [
+                {'year': y, 'week': w, 'stock_name': stock_name, 'change_pct': p}
+                for y, w, stock_name, p in rec_details[i]
+            ]
             
             result.append({
                 'name': name,
                 'total_count': total_count,
                 'win_count': win_count,
-                'win_rate': round(win_rate, 2),
+                'win_rate': round(win_rate_i, 2),
                 'positive_weeks': positive_weeks,
-                'weeks_count': total_weeks,
-                'weekly_win_rate': round(weekly_win_rate, 2),
-                'total_return': round(total_return, 2),
-                'avg_return': round(avg_return, 2),
+                'weeks_count': weeks_count,
+                'weekly_win_rate': round(weekly_win_rate_i, 2),
+                'total_return': round(total_return_i, 2),
+                'avg_return': round(avg_return_i, 2),
                 'score': score,
                 'rating': rating,
-                'weekly_returns': sorted_weekly,
-                'details': sorted_details
+                'weekly_returns': weekly_returns_list,
+                'details': details
             })
         
         # 按分数排序并保存
@@ -558,42 +628,44 @@ class RecommendationService:
     
     # ==================== 股票跟踪 ====================
     
-    def sync_stock_tracking(self, year: int, week: int, force: bool = False) -> Dict[str, Any]:
+    def sync_stock_tracking(self, year: int, week: int, force: bool = False,
+                            data: Dict[str, Any] = None) -> Dict[str, Any]:
         """同步周推荐数据到股票跟踪集合（批量分析版）
         
         Args:
             force: 是否强制重新同步（忽略已同步标记）
+            data: 已读取的周数据（批量同步时传入，避免重复查询）
         """
-        data = self.db.get_week_data(year, week)
+        if data is None:
+            data = self.db.get_week_data(year, week)
         recommender_messages = data.get('recommender_messages', {})
         
         # 检查是否已同步
         if not force and data.get('tracking_synced'):
-            print(f"[StockTracking] {year}年第{week}周: 已同步，跳过")
+            logger.info("[StockTracking] %s年第%s周: 已同步，跳过", year, week)
             return {'synced': 0, 'skipped': True}
         
         if not recommender_messages:
-            print(f"[StockTracking] {year}年第{week}周: 无推荐原文")
+            logger.info("[StockTracking] %s年第%s周: 无推荐原文", year, week)
             return {'synced': 0}
         
         # 计算周开始日期
-        start_date, _ = stock_service.get_week_dates(year, week)
-        date_str = f"{start_date[:4]}-{start_date[4:6]}-{start_date[6:]}"
+        date_str, _ = stock_service.get_week_range(year, week)
         
         # 1. 批量调用 Gemini 分析所有推荐原文
         analysis_result = self._batch_analyze_recommendations(recommender_messages)
         
         if not analysis_result:
-            print(f"[StockTracking] {year}年第{week}周: Gemini分析失败")
+            logger.warning("[StockTracking] %s年第%s周: Gemini分析失败", year, week)
             return {'synced': 0}
         
-        # 2. 遍历分析结果，填充代码并入库
+        # 2. 并发查询股票代码，再逐条入库
+        stock_infos = self._search_stocks(list(analysis_result))
         synced = 0
         for stock_name, recommenders_data in analysis_result.items():
-            # 查询股票代码
-            stock_info = stock_service.search_stock(stock_name)
+            stock_info = stock_infos.get(stock_name)
             if not stock_info:
-                print(f"[StockTracking] 跳过: {stock_name} (未找到代码)")
+                logger.debug("[StockTracking] 跳过: %s (未找到代码)", stock_name)
                 continue
             
             market = stock_info['market']
@@ -615,7 +687,7 @@ class RecommendationService:
         if synced > 0:
             self.db.mark_week_tracking_synced(year, week)
         
-        print(f"[StockTracking] 同步 {year}年第{week}周: {synced} 条推荐记录")
+        logger.info("[StockTracking] 同步 %s年第%s周: %s 条推荐记录", year, week, synced)
         return {'synced': synced}
     
     def _batch_analyze_recommendations(self, recommender_messages: Dict[str, str]) -> Dict[str, Dict[str, str]]:
@@ -645,40 +717,13 @@ class RecommendationService:
 5. 排除方向性词汇如"看好"、"关注"等，只保留实质性逻辑
 """
         
+        content = ''
         try:
-            resp = requests.post(
-                config.GEMINI_API_URL,
-                json={
-                    'text': input_text,
-                    'prompt': prompt,
-                    'use_structured_response': True,
-                    'response_format': {"items": [{"stock": "股票名称", "recommenders": [{"name": "推荐人名", "reason": "推荐逻辑"}]}]}
-                },
-                headers={'Token': config.GEMINI_API_TOKEN},
-                timeout=600
+            content = _post_gemini(
+                input_text, prompt,
+                {"items": [{"stock": "股票名称", "recommenders": [{"name": "推荐人名", "reason": "推荐逻辑"}]}]}
             )
-            
-            if resp.status_code != 200:
-                print(f"[StockTracking] Gemini API错误: {resp.status_code}")
-                return {}
-            
-            result = resp.json()
-            if result.get('errcode', 0) != 0:
-                print(f"[StockTracking] Gemini错误: {result.get('msg')}")
-                return {}
-            
-            content = result.get('content', '')
-            
-            # 解析JSON
-            import json
-            # 清理可能的markdown代码块
-            if content.startswith('```'):
-                content = content.split('\n', 1)[1] if '\n' in content else content
-                if content.endswith('```'):
-                    content = content[:-3]
-            content = content.strip()
-            
-            raw_parsed = json.loads(content)
+            raw_parsed = _loads_content(content)
             
             # 转换为期望的格式: {"股票名": {"推荐人": "逻辑"}}
             parsed = {}
@@ -695,33 +740,36 @@ class RecommendationService:
                     if name:
                         parsed[stock_name][name] = reason
             
-            print(f"[StockTracking] Gemini分析完成: {len(parsed)} 只股票")
+            logger.info("[StockTracking] Gemini分析完成: %s 只股票", len(parsed))
             return parsed
             
-        except json.JSONDecodeError as e:
-            print(f"[StockTracking] JSON解析失败: {e}, 内容: {content[:200]}")
+        except orjson.JSONDecodeError as e:
+            logger.warning("[StockTracking] JSON解析失败: %s, 内容: %s", e, content[:200])
             return {}
         except Exception as e:
-            print(f"[StockTracking] 分析失败: {e}")
+            logger.warning("[StockTracking] 分析失败: %s", e)
             return {}
     
     def sync_all_stock_tracking(self) -> Dict[str, Any]:
-        """从所有周数据同步到股票跟踪"""
-        weeks = self.db.get_all_weeks()
+        """从所有周数据同步到股票跟踪
+        
+        Returns:
+            weeks_scanned: 周数据总数；weeks_synced: 本次同步的（此前未同步的）周数；synced: 同步的推荐记录数
+        """
+        # 一次查询读出所有未同步的周，已同步的周不再读取
+        weeks = self.db.get_all_week_data(unsynced_only=True)
         total_synced = 0
         
-        for week_info in weeks:
-            year = week_info['year']
-            week = week_info['week']
-            result = self.sync_stock_tracking(year, week)
+        for (year, week), data in weeks.items():
+            result = self.sync_stock_tracking(year, week, data=data)
             total_synced += result.get('synced', 0)
         
-        print(f"[StockTracking] 全量同步完成: {total_synced} 条记录")
-        return {'weeks': len(weeks), 'synced': total_synced}
+        logger.info("[StockTracking] 全量同步完成: %s 条记录", total_synced)
+        return {'weeks_scanned': self.db.count_weeks(), 'weeks_synced': len(weeks), 'synced': total_synced}
     
-    def get_all_stock_tracking(self) -> Dict[str, Any]:
+    def get_all_stock_tracking(self, summary: bool = False, skip: int = 0, limit: int = 0) -> Dict[str, Any]:
         """获取所有股票跟踪数据"""
-        stocks = self.db.get_all_stock_tracking()
+        stocks = self.db.get_all_stock_tracking(summary=summary, skip=skip, limit=limit)
         return {'stocks': stocks, 'count': len(stocks)}
     
     def get_stock_tracking(self, market: str, stock_code: str) -> Dict[str, Any]:
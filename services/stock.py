@@ -3,18 +3,65 @@
 
 提供股票代码查询和K线数据获取
 """
+import atexit
+import logging
 import re
+import threading
 import time
+from functools import lru_cache
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Dict, Any, Optional, Tuple
+from typing import Dict, Any, List, Optional, Tuple
 import config
 
+logger = logging.getLogger(__name__)
+
+# 批量查询的并发数（新浪 suggest 接口不支持一次查多个名称）
+BULK_SEARCH_WORKERS = 10
+
+# 共享连接池：并发查询股票代码时复用 TCP 连接，请求头只设置一次
+# 新浪 suggest 为只读 GET，连接/读取失败可安全重试
+_session = requests.Session()
+_session.headers.update({
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+    "Referer": "http://finance.sina.com.cn/"
+})
+# 连接数按批量并发数的两倍预留，批量查询与接口上的单次查询同时进行时也不丢弃连接
+_adapter = HTTPAdapter(pool_connections=2, pool_maxsize=BULK_SEARCH_WORKERS * 2,
+                       max_retries=Retry(total=2, backoff_factor=0.3))
+_session.mount('http://', _adapter)
+_session.mount('https://', _adapter)
+atexit.register(_session.close)
+
+# 预编译正则：股票代码格式、新浪返回数据
+# 新浪返回 GBK 编码，GBK 双字节的第二字节不小于 0x40，'=' '"' 不会出现在汉字中间，可直接在字节上匹配
+_RE_CODE6 = re.compile(r'^\d{6}$')
+_RE_SINA = re.compile(rb'="([^"]+)"')
+# 单条结果（分号分隔）：取前4个逗号字段，其余字段整体跳过；不足5个字段的记录不匹配
+_RE_ITEM = re.compile(r'([^,;]*),([^,;]*),([^,;]*),([^,;]*),[^;]*')
+_A_SHARE_MARKETS = frozenset({'SH', 'SZ', 'BJ'})
+
+# 名称 -> 代码查询结果缓存：股票名与代码基本不变，成功结果长期缓存
+# 接口正常返回但未匹配的名称短期缓存，避免重复查询同一未知名称；请求失败不缓存
+SEARCH_CACHE_MAXSIZE = 2048
+SEARCH_MISS_TTL = 300
+SEARCH_MISS_MAXSIZE = 4096
+
+_search_cache = {}  # 规范化名称 -> {'market', 'code', 'name'}
+_search_miss_cache = {}  # 规范化名称 -> 未匹配的时间（time.monotonic）
+_search_cache_lock = threading.Lock()
+
 
 def search_stock(stock_name: str) -> Optional[Dict[str, str]]:
     """通过新浪接口搜索股票代码（与原系统一致）
     
+    结果缓存在进程内，名称忽略大小写和首尾空白：成功结果长期缓存，
+    未匹配的名称缓存 SEARCH_MISS_TTL 秒；网络异常等请求失败不缓存，下次重新请求
+    
     Args:
         stock_name: 股票名称
         
@@ -22,94 +69,173 @@ def search_stock(stock_name: str) -> Optional[Dict[str, str]]:
         {'market': 'sh/sz/bj', 'code': '600000', 'name': '浦发银行'} 或 None
     """
     # 检查是否已经是股票代码格式
-    if re.match(r'^\d{6}$', stock_name):
+    if _RE_CODE6.match(stock_name):
         market = _get_market_from_code(stock_name)
         return {'market': market.lower(), 'code': stock_name, 'name': None}
     
+    key = stock_name.strip().lower()
+    if not key:
+        return None
+    now = time.monotonic()
+    with _search_cache_lock:
+        cached = _search_cache.get(key)
+        if cached is None:
+            missed_at = _search_miss_cache.get(key)
+            if missed_at is not None:
+                if now - missed_at < SEARCH_MISS_TTL:
+                    return None
+                del _search_miss_cache[key]
+    if cached is not None:
+        return dict(cached)
+    
+    try:
+        result = _search_sina(stock_name)
+    except Exception as e:
+        logger.warning("[SearchStock] 异常: %s, %s: %s", stock_name, type(e).__name__, e)
+        return None
+    
+    with _search_cache_lock:
+        # 两个缓存 TTL 固定，最早写入的条目即最早过期，满了淘汰最早的
+        if result:
+            if len(_search_cache) >= SEARCH_CACHE_MAXSIZE:
+                _search_cache.pop(next(iter(_search_cache)))
+            _search_cache[key] = dict(result)
+        else:
+            if len(_search_miss_cache) >= SEARCH_MISS_MAXSIZE:
+                _search_miss_cache.pop(next(iter(_search_miss_cache)))
+            _search_miss_cache[key] = time.monotonic()
+    return result
+
+
+def clear_search_cache():
+    """清空股票代码查询缓存"""
+    with _search_cache_lock:
+        _search_cache.clear()
+        _search_miss_cache.clear()
+
+
+def _search_sina(stock_name: str) -> Optional[Dict[str, str]]:
+    """请求新浪 suggest 接口并解析第一条 A股/港股 结果
+    
+    返回 None 表示接口正常但没有匹配的股票；请求失败（网络异常、非200）抛出异常
+    """
     timestamp = str(int(time.time() * 1000))
     # 原系统使用的URL格式
     url = f"http://suggest3.sinajs.cn/suggest/key={quote(stock_name)}&name=suggestdata_{timestamp}"
     
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
-        "Referer": "http://finance.sina.com.cn/"
-    }
+    resp = _session.get(url, timeout=10)
     
-    try:
-        resp = requests.get(url, headers=headers, timeout=10)
-        
-        if resp.status_code != 200:
-            print(f"[SearchStock] API错误: {stock_name}, status={resp.status_code}")
-            return None
-        
-        # 新浪接口返回 GBK 编码
-        content = resp.content.decode('gbk', errors='ignore')
-        print(f"[SearchStock] 响应: {stock_name} -> {content[:200]}")
-        
-        match = re.search(r'="([^"]+)"', content)
-        if not match:
-            print(f"[SearchStock] 正则匹配失败: {stock_name}")
-            return None
-        
-        data_str = match.group(1)
-        if not data_str:
-            print(f"[SearchStock] 空数据: {stock_name}")
-            return None
+    if resp.status_code != 200:
+        raise requests.HTTPError(f"API错误 status={resp.status_code}", response=resp)
+    
+    # 新浪接口返回 GBK 编码：在原始字节上匹配，只解码引号内的数据
+    content = resp.content
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("[SearchStock] 响应: %s -> %s", stock_name, content[:200].decode('gbk', errors='ignore'))
+    
+    match = _RE_SINA.search(content)
+    if not match:
+        logger.debug("[SearchStock] 正则匹配失败: %s", stock_name)
+        return None
+    
+    data_str = match.group(1).decode('gbk', errors='ignore')
+    if not data_str:
+        logger.debug("[SearchStock] 空数据: %s", stock_name)
+        return None
+    
+    # 解析结果：格式为 股票名,市场类型,代码,市场代码,简称,...;
+    # A股: 星图测控,11,920116,bj920116,星图测控,,星图测控,99,1,,,
+    # 港股: 第四范式,31,06682,06682,第四范式,,第四范式,99,1,,,
+    for item in _RE_ITEM.finditer(data_str):
+        # 股票名称（用于矫正）, 市场类型（11=A股, 31=港股, 41=美股）, 股票代码, 市场+代码（如 bj920116 或 06682）
+        name, market_type, code, code_full = item.groups()
+        # 只有5位（港股）、6位（A股）代码可能命中，美股等其他候选直接跳过
+        if len(code) not in (5, 6) or not code.isdigit():
+            continue
         
-        # 解析结果：格式为 股票名,市场类型,代码,市场代码,简称,...;
-        # A股: 星图测控,11,920116,bj920116,星图测控,,星图测控,99,1,,,
-        # 港股: 第四范式,31,06682,06682,第四范式,,第四范式,99,1,,,
-        items = data_str.split(';')
-        for item in items:
-            if not item.strip():
-                continue
-            parts = item.split(',')
-            if len(parts) > 4:
-                name = parts[0]  # 股票名称（用于矫正）
-                market_type = parts[1]  # 市场类型：11=A股, 31=港股, 41=美股
-                code = parts[2]  # 股票代码
-                code_full = parts[3]  # 市场+代码，如 bj920116 或 06682
-                
-                # 港股: 市场类型 31，5位数字代码
-                if market_type == '31' and re.match(r'^\d{5}$', code):
-                    print(f"[SearchStock] 成功(港股): {stock_name} -> HK.{code} ({name})")
-                    return {'market': 'HK', 'code': code, 'name': name}
-                
-                # A股: 6位数字 -> 从 code_full 提取市场
-                if re.match(r'^\d{6}$', code):
-                    market = code_full.replace(code, '').upper()  # bj920116.replace(920116, '') = bj -> BJ
-                    if market in ['SH', 'SZ', 'BJ']:
-                        print(f"[SearchStock] 成功: {stock_name} -> {market}.{code} ({name})")
-                        return {'market': market, 'code': code, 'name': name}
+        # 港股: 市场类型 31，5位数字代码
+        if market_type == '31' and len(code) == 5:
+            logger.debug("[SearchStock] 成功(港股): %s -> HK.%s (%s)", stock_name, code, name)
+            return {'market': 'HK', 'code': code, 'name': name}
         
-        print(f"[SearchStock] 未匹配: {stock_name}")
-        return None
+        # A股: 6位数字 -> 从 code_full 提取市场
+        if len(code) == 6:
+            market = code_full[:-6].upper()  # bj920116 去掉末尾6位代码 = bj -> BJ
+            if market in _A_SHARE_MARKETS:
+                logger.debug("[SearchStock] 成功: %s -> %s.%s (%s)", stock_name, market, code, name)
+                return {'market': market, 'code': code, 'name': name}
+    
+    logger.debug("[SearchStock] 未匹配: %s", stock_name)
+    return None
+
+
+
+def search_stocks_bulk(stock_names: List[str]) -> Dict[str, Optional[Dict[str, str]]]:
+    """批量搜索股票代码
+    
+    Args:
+        stock_names: 股票名称列表（自动去重）
         
-    except Exception as e:
-        print(f"[SearchStock] 异常: {stock_name}, {type(e).__name__}: {e}")
-        return None
+    Returns:
+        {股票名称: search_stock 结果或 None}
+    """
+    names = list(dict.fromkeys(n for n in stock_names if n))
+    if not names:
+        return {}
+    if len(names) == 1:
+        return {names[0]: search_stock(names[0])}
+    with ThreadPoolExecutor(max_workers=min(BULK_SEARCH_WORKERS, len(names))) as executor:
+        return dict(zip(names, executor.map(search_stock, names)))
+
+
+# 代码前缀 -> 市场：60/68 开头为上海，8/4/9 开头为北交所，其余（00/30 等）为深圳
+_MARKET_BY_PREFIX2 = {'60': 'SH', '68': 'SH'}
+_MARKET_BY_PREFIX1 = {'8': 'BJ', '4': 'BJ', '9': 'BJ'}
 
 
 def _get_market_from_code(code: str) -> str:
     """根据股票代码判断市场"""
-    if code.startswith(('60', '68')):
-        return 'SH'
-    elif code.startswith(('00', '30')):
-        return 'SZ'
-    elif code.startswith(('8', '4', '9')):
-        return 'BJ'
-    return 'SZ'
+    return _MARKET_BY_PREFIX2.get(code[:2]) or _MARKET_BY_PREFIX1.get(code[:1], 'SZ')
+
+
+# 每年第1~53周的起止日期表，首次用到某年时一次算出
+_week_dates_tables = {}  # year -> ((周一, 周五), ...)
+
+
+def _week_dates_table(year: int) -> Tuple[Tuple[str, str], ...]:
+    table = _week_dates_tables.get(year)
+    if table is None:
+        # ISO周从周一开始
+        jan4 = datetime(year, 1, 4)
+        first = jan4 - timedelta(days=jan4.weekday())
+        table = tuple(
+            ((first + timedelta(weeks=i)).strftime('%Y%m%d'),
+             (first + timedelta(weeks=i, days=4)).strftime('%Y%m%d'))  # 周五
+            for i in range(53)
+        )
+        _week_dates_tables[year] = table
+    return table
 
 
 def get_week_dates(year: int, week: int) -> Tuple[str, str]:
     """获取指定周的起止日期"""
-    # ISO周从周一开始
+    if 1 <= week <= 53:
+        return _week_dates_table(year)[week - 1]
+    # 超出范围的周数按原公式推算（跨到相邻年份）
     jan4 = datetime(year, 1, 4)
     start = jan4 - timedelta(days=jan4.weekday()) + timedelta(weeks=week-1)
     end = start + timedelta(days=4)  # 周五
     return start.strftime('%Y%m%d'), end.strftime('%Y%m%d')
 
 
+@lru_cache(maxsize=512)
+def get_week_range(year: int, week: int) -> Tuple[str, str]:
+    """获取指定周的起止日期（YYYY-MM-DD 格式，结果缓存）"""
+    start_date, end_date = get_week_dates(year, week)
+    return (f"{start_date[:4]}-{start_date[4:6]}-{start_date[6:]}",
+            f"{end_date[:4]}-{end_date[4:6]}-{end_date[6:]}")
+
+
 def get_kline(market: str, code: str, year: int, week: int) -> Optional[Dict[str, Any]]:
     """获取K线数据（使用ashare接口）
     
@@ -123,8 +249,10 @@ def get_kline(market: str, code: str, year: int, week: int) -> Optional[Dict[str
         {'open_price': float, 'close_price': float, 'change_pct': float} 或 None
     """
     try:
+        # 延迟导入：services.ashare 依赖 pandas，只在首次获取K线时加载，
+        # 避免导入 stock（进而 mongodb_db / cache_db）时拖慢冷启动
         from services.ashare import get_kline as ashare_get_kline
         return ashare_get_kline(market, code, year, week)
     except Exception as e:
-        print(f"[K线] 获取失败: {market}{code}, {e}")
+        logger.warning("[K线] 获取失败: %s%s, %s", market, code, e)
         return None